@@ -18,6 +18,7 @@ set PYTHONBIN=%PYTHONDIR%\python.exe
 set PIPBIN=%PYTHONDIR%\Scripts\pip.exe
 set PIPURL=https://bootstrap.pypa.io/get-pip.py
 set SMSSTEMP=%BASEPATH%\temp
+set SMSSARGS=
 
 if NOT "%BASEPATH%"=="%BASEPATH: =%" goto :noSpaces
 
@@ -128,11 +129,16 @@ for %%x in (bs4 colorama requests) do (
 )
 
 :runScript
-"%PYTHONBIN%" %CORESCRIPT%
+REM If a supervise file exists, the script restarts the server itself
+if exist "%BASEPATH%\supervise*" set SMSSARGS=--supervise
+"%PYTHONBIN%" %CORESCRIPT% %SMSSARGS%
 
 REM If a single_run file exists exit at this time
 if exist "%BASEPATH%\single_run*" goto :singleRun
 
+REM If a stop file exists exit at this time
+if exist "%BASEPATH%\stop*" goto :stop
+
 goto :start
 
 :noSpaces
@@ -145,5 +151,10 @@ echo A file or directory starting with "single_run" exists. Remove this file to
 echo allow the server to restart.
 goto :end
 
+:stop
+echo A file or directory starting with "stop" exists. Remove this file to
+echo allow the server to restart.
+goto :end
+
 :end
 pause
\ No newline at end of file
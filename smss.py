@@ -1,29 +1,681 @@
-from bs4 import BeautifulSoup 
-from colorama import init
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from copy import deepcopy
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 from glob import glob
 from pathlib import Path
-from random import randint
-from urllib import request
+from random import randint, uniform
+from urllib.parse import urlsplit
 import asyncio
-import fileinput
+import contextvars
+import functools
+import hashlib
+import inspect
 import itertools
 import json
 import logging
+import logging.handlers
 import math
 import os
-import requests
+import re
 import shutil
-import sqlite3
 import sys
 import threading
 import time
-import zipfile
 
 sys.path.insert(0, '')
-init(convert=True)
 
+# Objects within this many meters of a base's plot sign belong to that base
+BASE_RADIUS = 30
+
+# SteamID64 of the account with AccountID 0
+STEAM_ID64_BASE = 76561197960265728
+
+# Methods called too often, or for too long, to be worth a trace span each
+UNTRACED_METHODS = ('calc_distance', 'database_session', 'get_grid_cell',
+                    'get_result_set', 'hash_install_file', 'is_integrity_excluded',
+                    'parse_server_status', 'read_stream', 'spinner')
+
+class SmssTracer:
+    """
+    Records nested, timed spans of work. Spans can carry values such as rows
+    affected or bytes transferred, and are written out in the Chrome trace
+    event format (load the file in chrome://tracing or Perfetto).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stack = contextvars.ContextVar('smss_trace_stack', default=())
+        self.main_thread = threading.get_ident()
+        self.reset()
+
+
+    def reset(self):
+        """Discards recorded spans so a new run can be traced
+        """
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.spans = list()
+
+
+    @contextmanager
+    def span(self, name, **args):
+        """Times the with block as a span nested inside the current span
+
+        Args:
+            name (string): span name
+            args: values recorded with the span
+
+        Yields:
+            dictionary: the span's values, which the block may add to
+        """
+        parent = self.stack.get()
+        record = {
+            'name': name,
+            'start': time.perf_counter(),
+            'depth': len(parent),
+            'thread': threading.get_ident(),
+            'args': args}
+        token = self.stack.set(parent + (record,))
+        try:
+            yield record['args']
+        finally:
+            record['duration'] = time.perf_counter() - record['start']
+            self.stack.reset(token)
+            with self.lock:
+                self.spans.append(record)
+
+
+    def summary(self):
+        """Returns the top level spans of the main thread in start order
+
+        Returns:
+            list: (name, duration in seconds) tuples
+        """
+        with self.lock:
+            spans = [s for s in self.spans if s['depth'] == 0 and s['thread'] == self.main_thread]
+        return [(s['name'], s['duration']) for s in sorted(spans, key=lambda s: s['start'])]
+
+
+    def elapsed(self):
+        """Returns the wall clock time covered by the top level spans of the
+           main thread, which may overlap
+
+        Returns:
+            float: seconds from the start of the first to the end of the last span
+        """
+        with self.lock:
+            spans = [s for s in self.spans if s['depth'] == 0 and s['thread'] == self.main_thread]
+        if not spans:
+            return 0
+        return max(s['start'] + s['duration'] for s in spans) - min(s['start'] for s in spans)
+
+
+    def traced(self, function, name):
+        """Wraps a function or coroutine function in a span
+
+        Args:
+            function (function): the function to be wrapped
+            name (string): span name
+
+        Returns:
+            function: the wrapped function
+        """
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+        return wrapper
+
+
+    def write_chrome_trace(self, file_name):
+        """Writes the recorded spans as a Chrome trace event file
+
+        Args:
+            file_name (Path): where the trace is written
+        """
+        with self.lock:
+            events = [{
+                'name': s['name'],
+                'ph': 'X',
+                'ts': round((s['start'] - self.origin) * 1000000),
+                'dur': round(s['duration'] * 1000000),
+                'pid': os.getpid(),
+                'tid': s['thread'],
+                'args': {k: v if isinstance(v, (int, float, bool)) else str(v) for k, v in s['args'].items()}}
+                for s in self.spans]
+        temp_file = Path(f'{file_name}.tmp')
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+            os.replace(temp_file, file_name)
+        except OSError as e:
+            logging.debug(e)
+
+
+tracer = SmssTracer()
+
+
+def trace_methods(cls):
+    """
+    Summary: Class decorator wrapping each public method of a class, except
+    those in UNTRACED_METHODS, in a tracer span.
+    """
+    for name, member in list(vars(cls).items()):
+        if name.startswith('_') or name in UNTRACED_METHODS:
+            continue
+        if not inspect.isfunction(member) or inspect.isgeneratorfunction(member):
+            continue
+        setattr(cls, name, tracer.traced(member, name))
+    return cls
+
+
+class SmssCache:
+    """
+    A small JSON file backed cache. Entries expire after ttl seconds and the
+    oldest entries are evicted once more than max_entries are stored.
+    """
+    def __init__(self, path, ttl, max_entries=256):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except Exception as e:
+            logging.debug(e)
+            self.entries = dict()
+
+
+    def get(self, key, default=None, max_age=None):
+        """Returns a cached value if it exists and has not expired
+
+        Args:
+            key (string): cache key
+            default: value returned on a cache miss
+            max_age (float): seconds after which the entry is treated as
+                             expired; defaults to the cache's ttl
+
+        Returns:
+            the cached value or default
+        """
+        max_age = self.ttl if max_age is None else max_age
+        entry = self.entries.get(str(key))
+        if entry is None or time.time() - entry['time'] > max_age:
+            return default
+        return entry['value']
+
+
+    def save(self):
+        """Writes the cache to disk, replacing the previous file atomically
+        """
+        # Held until the file is replaced so concurrent saves don't share the temp file
+        with self.lock:
+            temp_file = Path(f'{self.path}.tmp')
+            try:
+                with open(temp_file, 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(temp_file, self.path)
+            except OSError as e:
+                logging.debug(e)
+
+
+    def set(self, key, value):
+        """Stores a value, evicting the oldest entries if the cache is full
+
+        Args:
+            key (string): cache key
+            value: any JSON serializable value
+        """
+        with self.lock:
+            self.entries[str(key)] = {'time': time.time(), 'value': value}
+            excess = len(self.entries) - self.max_entries
+            if excess > 0:
+                oldest = sorted(self.entries, key=lambda k: self.entries[k]['time'])
+                for this_key in oldest[:excess]:
+                    del self.entries[this_key]
+
+
+class SmssConfigFile:
+    """
+    A config file which is parsed once, updated in memory, and written back
+    atomically only if its contents changed. "cfg" files hold variable=value
+    lines; "json" files hold a JSON object.
+    """
+    def __init__(self, path, format='cfg'):
+        self.path = Path(path)
+        self.format = format
+        try:
+            with open(self.path) as f:
+                text = f.read()
+        except OSError:
+            text = ''
+        if format == 'json':
+            try:
+                self.data = json.loads(text) if text.strip() else dict()
+            except ValueError as e:
+                logging.debug(e)
+                self.data = None
+        else:
+            self.lines = text.splitlines()
+        self.digest = self.get_digest()
+
+
+    def get_digest(self):
+        """Returns a hash of the contents the file would be written with
+
+        Returns:
+            string: SHA-1 hex digest
+        """
+        return hashlib.sha1(self.render().encode('utf-8')).hexdigest()
+
+
+    def render(self):
+        """Returns the contents the file would be written with
+
+        Returns:
+            string: file contents
+        """
+        if self.format == 'json':
+            return json.dumps(self.data, indent=4)
+        return ''.join(f'{line}\n' for line in self.lines)
+
+
+    def save(self):
+        """Writes the file through a temporary file if its contents changed
+
+        Returns:
+            bool: True if the file was written
+        """
+        digest = self.get_digest()
+        if digest == self.digest:
+            logging.debug(f'{self.path} is unchanged')
+            return False
+        temp_file = Path(f'{self.path}.tmp')
+        with open(temp_file, 'w') as f:
+            f.write(self.render())
+        os.replace(temp_file, self.path)
+        self.digest = digest
+        logging.debug(f'{self.path} written')
+        return True
+
+
+    def set(self, variable, value):
+        """Replaces every line setting a variable, matched case-insensitively,
+           or appends one if there is none
+
+        Args:
+            variable (string): variable name
+            value (string): the new value for the variable
+        """
+        prefix = f'{variable.lower()}='
+        replaced = False
+        for index, line in enumerate(self.lines):
+            if line.strip().lower().startswith(prefix):
+                self.lines[index] = f'{variable}={value}'
+                replaced = True
+        if not replaced:
+            self.lines.append(f'{variable}={value}')
+
+
+class SmssHttp:
+    """
+    A shared HTTP client. Connections are pooled and kept alive, failed
+    requests are retried with exponential backoff, and each host has a
+    circuit breaker which opens after repeated failures. Breaker state is
+    kept on disk so a restart doesn't wait on a host which just failed. In
+    offline mode no requests are made at all.
+    """
+    def __init__(self, state_path, timeouts=None, default_timeout=10, retries=2, backoff=0.5,
+                 failure_threshold=3, cooldown=300, pool_size=8, offline=False):
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.pool_size = pool_size
+        self.offline = offline
+        self.breakers = SmssCache(state_path, ttl=float('inf'))
+        self.probes = dict()
+        self.lock = threading.Lock()
+        self.session = None
+
+
+    def get_session(self):
+        """Returns the pooled session, creating it on first use
+
+        Returns:
+            requests.Session: the shared session
+        """
+        import requests
+
+        with self.lock:
+            if self.session is None:
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+                self.session.mount('https://', adapter)
+                self.session.mount('http://', adapter)
+            return self.session
+
+
+    def is_open(self, host):
+        """Returns whether a host's circuit breaker is open. Once the
+           cooldown has passed a single probe request is let through and
+           every other caller is refused until it completes; if the probe
+           fails too the breaker opens again.
+
+        Args:
+            host (string): host name
+
+        Returns:
+            bool: True if requests to the host should not be made
+        """
+        with self.lock:
+            breaker = self.breakers.get(host, {})
+            if breaker.get('failures', 0) < self.failure_threshold:
+                return False
+            now = time.time()
+            if now - breaker.get('opened', 0) < self.cooldown:
+                return True
+            # A probe which never recorded its outcome doesn't block the host forever
+            if now - self.probes.get(host, 0) < self.cooldown:
+                return True
+            self.probes[host] = now
+            return False
+
+
+    def record(self, host, succeeded):
+        """Records the outcome of a request in the host's circuit breaker
+
+        Args:
+            host (string): host name
+            succeeded (bool): whether the request succeeded
+        """
+        with self.lock:
+            self.probes.pop(host, None)
+            failures = self.breakers.get(host, {}).get('failures', 0)
+            if succeeded:
+                if not failures:
+                    return
+                self.breakers.set(host, {'failures': 0, 'opened': 0})
+            else:
+                failures += 1
+                opened = time.time() if failures >= self.failure_threshold else 0
+                self.breakers.set(host, {'failures': failures, 'opened': opened})
+                if opened:
+                    logging.info(f'{host} keeps failing; skipping it for {self.cooldown} seconds')
+        self.breakers.save()
+
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """Makes an HTTP request over the pooled session. Connection errors,
+           429 and 5xx responses are retried with exponential backoff and
+           jitter. Timeouts are not retried, so a slow host costs one timeout.
+
+        Args:
+            method (string): HTTP method
+            url (string): URL to request
+            timeout (float): seconds to wait; defaults to the host's timeout
+            kwargs: passed on to requests.Session.request
+
+        Returns:
+            requests.Response: the response
+
+        Raises:
+            ConnectionError: in offline mode or while the host's breaker is open
+            requests.RequestException: if every attempt failed
+        """
+        import requests
+
+        host = urlsplit(url).hostname
+        if self.offline:
+            raise ConnectionError(f'Offline mode; not requesting {url}')
+        if self.is_open(host):
+            raise ConnectionError(f'{host} failed recently; not requesting {url}')
+        timeout = timeout or self.timeouts.get(host, self.default_timeout)
+
+        with tracer.span('http', url=url) as span:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1) * uniform(0.5, 1.5))
+                span['attempts'] = attempt + 1
+                try:
+                    response = self.get_session().request(method, url, timeout=timeout, **kwargs)
+                except requests.Timeout as e:
+                    logging.debug(f'{method} {url} timed out: {e}')
+                    error = e
+                    break
+                except requests.RequestException as e:
+                    logging.debug(f'{method} {url} failed: {e}')
+                    error = e
+                    continue
+                if response.status_code == 429 or response.status_code >= 500:
+                    logging.debug(f'{method} {url} returned {response.status_code}')
+                    error = requests.HTTPError(f'{response.status_code} from {url}', response=response)
+                    response.close()
+                    continue
+                span['status'] = response.status_code
+                if not kwargs.get('stream'):
+                    span['bytes'] = len(response.content)
+                self.record(host, True)
+                return response
+
+            self.record(host, False)
+            raise error
+
+
+class SmssRcon:
+    """
+    An asyncio client for the Miscreated server's XML-RPC RCON interface.
+    One HTTP connection is kept alive for every command, and the challenge
+    and authenticate handshake is done once per connection.
+    """
+    def __init__(self, host, port, password, timeout=5):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.authenticated = False
+
+
+    async def authenticate(self):
+        """Answers the server's challenge with an MD5 digest of the challenge
+           and the RCON password
+
+        Raises:
+            PermissionError: if the server rejects the password
+        """
+        challenge = await self.call('challenge')
+        digest = hashlib.md5(f'{challenge}:{self.password}'.encode()).hexdigest()
+        result = await self.call('authenticate', digest)
+        if result != 'authorized':
+            raise PermissionError(f'RCON authentication failed: {result}')
+        self.authenticated = True
+
+
+    async def call(self, method, *params):
+        """Makes an XML-RPC call over the kept-alive connection, connecting
+           first if needed
+
+        Args:
+            method (string): XML-RPC method name
+            params: method parameters
+
+        Returns:
+            the value returned by the server
+        """
+        import xmlrpc.client
+
+        try:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout)
+                self.authenticated = False
+
+            body = xmlrpc.client.dumps(params, method).encode()
+            self.writer.write(f'POST /rpc2 HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n'
+                              f'Content-Type: text/xml\r\nContent-Length: {len(body)}\r\n'
+                              'Connection: keep-alive\r\n\r\n'.encode() + body)
+            await self.writer.drain()
+            keep_alive, body = await asyncio.wait_for(self.read_response(), self.timeout)
+            if not keep_alive:
+                await self.close()
+            return xmlrpc.client.loads(body)[0][0]
+        except BaseException:
+            # A reply may still be on its way; never read it as the next call's
+            await self.close()
+            raise
+
+
+    async def close(self):
+        """Closes the connection
+        """
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+        self.authenticated = False
+
+
+    async def read_response(self):
+        """Reads an HTTP response from the connection
+
+        Returns:
+            tuple: whether the connection stays open, and the response body
+        """
+        status = (await self.reader.readline()).decode(errors='replace')
+        if not status:
+            raise ConnectionError('RCON connection closed by the server')
+        if ' 200 ' not in f'{status} ':
+            raise ConnectionError(f'RCON request failed: {status.strip()}')
+        headers = dict()
+        while True:
+            line = (await self.reader.readline()).decode(errors='replace').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+        keep_alive = headers.get('connection') != 'close' and status.startswith('HTTP/1.1')
+        if 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            keep_alive = False
+        return keep_alive, body
+
+
+    async def send(self, command):
+        """Runs an RCON command, authenticating first on a new connection.
+           If a kept-alive connection turns out to be dead or stops
+           answering it is reopened once.
+
+        Args:
+            command (string): console command
+
+        Returns:
+            string: the command's output
+        """
+        for attempt in range(2):
+            reused = self.writer is not None
+            try:
+                if not self.authenticated:
+                    await self.authenticate()
+                return await self.call(command)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                await self.close()
+                if attempt or not reused:
+                    raise
+                logging.debug(f'RCON connection lost, reconnecting: {e}')
+
+
+class SmssScheduler:
+    """
+    Runs startup steps in a thread pool, starting each step as soon as the
+    steps it depends on have finished, and reports the critical path: the
+    chain of steps which determined when the last one finished.
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.steps = dict()
+        self.timings = dict()
+
+
+    def add(self, name, function, after=()):
+        """Declares a step. Steps may only depend on steps declared before
+           them, which keeps the steps free of cycles.
+
+        Args:
+            name (string): step name
+            function (function): called without arguments to run the step
+            after (tuple): names of the steps which must finish first
+        """
+        unknown = [dependency for dependency in after if dependency not in self.steps]
+        if unknown:
+            raise ValueError(f'Step {name} depends on undeclared steps: {", ".join(unknown)}')
+        self.steps[name] = (function, tuple(after))
+
+
+    def critical_path(self):
+        """Returns the steps which determined when the last step finished,
+           following each step back to the dependency which finished last
+
+        Returns:
+            list: (name, duration in seconds) tuples in the order they ran
+        """
+        path = list()
+        name = max(self.timings, key=lambda n: self.timings[n][1], default=None)
+        while name is not None:
+            start, end = self.timings[name]
+            path.append((name, end - start))
+            after = [dependency for dependency in self.steps[name][1] if dependency in self.timings]
+            name = max(after, key=lambda n: self.timings[n][1], default=None)
+        return path[::-1]
+
+
+    async def run_steps(self):
+        """Runs every declared step. Steps whose dependencies failed are not
+           run, and the first failure is raised once every other step has
+           finished.
+        """
+        loop = asyncio.get_running_loop()
+        tasks = dict()
+
+        async def run_step(name):
+            function, after = self.steps[name]
+            await asyncio.gather(*(tasks[dependency] for dependency in after))
+            with tracer.span(name):
+                start = time.perf_counter()
+                try:
+                    # Spans opened by the step nest under this step's span
+                    await loop.run_in_executor(executor, contextvars.copy_context().run, function)
+                finally:
+                    self.timings[name] = (start, time.perf_counter())
+
+        self.timings = dict()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for name in self.steps:
+                tasks[name] = asyncio.create_task(run_step(name))
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+
+@trace_methods
 class SmssConfig:
     """
     The Simplified Miscreated Server Setup class installs and configures a
@@ -44,6 +696,25 @@ class SmssConfig:
         self.reset_vehicle_clan_ids = self.config.get("reset_vehicle_clan_ids", [])
         self.reset_vehicle_owner_ids = self.config.get("reset_vehicle_owner_ids", [])
 
+        # AccountIDs whose bases, tents, and vehicles are reset; these are
+        # resolved from the owner and clan ids above by database_tricks
+        self.reset_base_account_ids = frozenset()
+        self.reset_tent_account_ids = frozenset()
+        self.reset_vehicle_account_ids = frozenset()
+
+        # How tents and vehicles near bases are matched: "grid" (in Python),
+        # "numpy" (vectorized, needs numpy) or "rtree" (inside SQLite)
+        self.distance_engine = self.config.get("distance_engine", "grid")
+        self.distance_memory_budget_mb = self.config.get("distance_memory_budget_mb", 64)
+
+        # Database session shared by all statements inside database_session()
+        self.db_connection = None
+        self.database_pragmas = self.config.get("database_pragmas", {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -16000,
+            "temp_store": "MEMORY"})
+
         # Create a random server service ID
         this_random_number = str(randint(0, 999999)).rjust(6, "0")
         self.config["nt_service_name"] = self.config.get("nt_service_name", f'MiscreatedService{this_random_number}')
@@ -56,18 +727,60 @@ class SmssConfig:
         # SteamCMD installation directory
         self.steamcmd_path = Path(f"{self.script_path}/SteamCMD")
 
+        # Server updates are downloaded here while the server is running
+        self.staging_path = Path(f"{self.script_path}/MiscreatedServerStaging")
+
         # A place where we'll store temporary files
         self.temp_path = Path(f"{self.script_path}/temp")
         
         # Create required paths
         self.create_required_paths()
 
+        # Steam Workshop lookups for the server start summary screen
+        self.workshop_url = self.config.get("workshop_url", "https://steamcommunity.com/sharedfiles/filedetails/?id={}")
+        self.workshop_timeout = self.config.get("workshop_timeout", 5)
+        self.workshop_workers = self.config.get("workshop_workers", 8)
+        self.workshop_details_url = self.config.get("workshop_details_url", "https://api.steampowered.com/ISteamRemoteStorage/GetPublishedFileDetails/v1/")
+        self.mod_details_ttl = self.config.get("mod_details_ttl", 300)
+        self.mod_cache = SmssCache(Path(f"{self.temp_path}/mod_cache.json"),
+                                   ttl=self.config.get("mod_cache_ttl", 86400),
+                                   max_entries=self.config.get("mod_cache_size", 256))
+
+        # Size, mtime, and hash of every installed server file, recorded
+        # after validation so routine restarts can skip SteamCMD validate
+        self.install_manifest_file = Path(f"{self.temp_path}/install_manifest.json")
+        self.integrity_workers = int(self.config.get("integrity_workers", 8))
+        self.integrity_exclude = self.config.get("integrity_exclude", [
+            "Mods", "SvServerAdmin", "steamapps", "logs", "hosting.cfg",
+            "smss.managed", "miscreated.db*", "*.log", "*.tmp"])
+
+        # Workshop time_updated of each mod in the Mods directory
+        self.mods_manifest_file = Path(f"{self.temp_path}/mods_manifest.json")
+
+        # The latest public server build ID is only looked up once per TTL
+        self.build_cache = SmssCache(Path(f"{self.temp_path}/build_cache.json"),
+                                     ttl=self.config.get("build_id_cache_ttl", 600))
+
+        # Every HTTP request goes through one pooled client. In offline mode
+        # last known build IDs and mod details are used instead
+        self.http = SmssHttp(Path(f"{self.temp_path}/http_state.json"),
+                             timeouts={'api.steamcmd.net': 10,
+                                       'api.steampowered.com': self.workshop_timeout,
+                                       'steamcommunity.com': self.workshop_timeout,
+                                       **self.config.get("http_timeouts", {})},
+                             retries=int(self.config.get("http_retries", 2)),
+                             failure_threshold=int(self.config.get("http_failure_threshold", 3)),
+                             cooldown=float(self.config.get("http_cooldown", 300)),
+                             pool_size=int(self.workshop_workers),
+                             offline=self.config.get("offline", False))
+
         # Configure filename variables
         self.config_file = kwargs.get('config_file', Path(f'{self.script_path}/smss.json'))
         self.miscreated_server_cmd = Path(f"{self.miscreated_server_path}/Bin64_dedicated/MiscreatedServer.exe")
         self.miscreated_server_config = Path(f"{self.miscreated_server_path}/hosting.cfg")
         self.miscreated_server_db = Path(f"{self.miscreated_server_path}/miscreated.db")
-        self.steamcmd = Path(f"{self.steamcmd_path}/steamcmd.exe")
+        self.miscreated_server_manifest = Path(f"{self.miscreated_server_path}/steamapps/appmanifest_302200.acf")
+        self.steamcmd = Path(self.config.get("steamcmd", f"{self.steamcmd_path}/steamcmd.exe"))
 
         # Variable contianing hosting.cfg contents
         self.sv_maxuptime_range = self.config.get("sv_maxuptime_range", dict())
@@ -84,44 +797,283 @@ class SmssConfig:
         self.command_line_settings = dict()
         self.command_line_settings['sv_servername'] = self.hosting_config.get('sv_servername', False)
 
+        # Output of the server and SteamCMD goes to a size-rotated log file;
+        # only the most recent lines are kept in memory for crash diagnostics
+        self.recent_output = deque(maxlen=int(self.config.get("output_tail_lines", 200)))
+        self.output_log = logging.getLogger('smss.output')
+        self.output_log.propagate = False
+        self.output_log.setLevel(logging.INFO)
+        if not self.output_log.handlers:
+            output_handler = logging.handlers.RotatingFileHandler(
+                Path(f"{self.script_path}/smss_output.log"),
+                maxBytes=int(self.config.get("output_log_max_bytes", 10 * 1024 * 1024)),
+                backupCount=int(self.config.get("output_log_backups", 3)),
+                encoding='utf-8',
+                delay=True)
+            output_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.output_log.addHandler(output_handler)
+
+        # Pre-staging of the next session while the server is running
+        self.prestage_enabled = self.config.get("prestage_enabled", False)
+        self.prestage_lead_minutes = float(self.config.get("prestage_lead_minutes", 15))
+        self.prestage_cancel = threading.Event()
+        self.prestage_thread = None
+        self.staged_build_file = Path(f"{self.staging_path}/smss.staged")
+
+        # Every session is recorded in the run journal for trend reports
+        self.journal_file = Path(f"{self.script_path}/smss_journal.db")
+
+        # Names of the startup steps on the critical path of the last startup
+        self.critical_path = list()
+
+        # Player count, uptime, and FPS polled over RCON while the server runs
+        self.rcon_poll_interval = float(self.config.get("rcon_poll_interval", 60))
+        self.server_metrics = deque(maxlen=int(self.config.get("rcon_metrics_size", 1440)))
+
+        # Database maintenance while the server is running; off by default
+        self.online_maintenance_interval = float(self.config.get("online_maintenance_minutes", 0)) * 60
+        self.online_maintenance_budget = float(self.config.get("online_maintenance_budget_ms", 250)) / 1000
+        self.online_database_pragmas = {
+            "busy_timeout": int(self.config.get("online_busy_timeout_ms", 100)),
+            "temp_store": "MEMORY"}
+        self.online_maintenance_step = 0
+        self.reset_counts = dict(base=0, tent=0, vehicle=0)
+        self.rows_changed = 0
+
+
+    async def maintain_database(self):
+        """Runs online_database_tricks every online_maintenance_minutes while
+           the server is running. When the game holds the database lock or
+           a run fails the next attempt is made sooner, backing off
+           exponentially up to the normal interval. Runs until cancelled.
+        """
+        logging.debug('async method: maintain_database')
+        if self.online_maintenance_interval <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        delay = self.online_maintenance_interval
+        retry_delay = 5
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                completed = await loop.run_in_executor(None, self.online_database_tricks)
+            except Exception as e:
+                logging.info(f'Online database maintenance failed: {e}')
+                completed = False
+            if completed:
+                delay = self.online_maintenance_interval
+                retry_delay = 5
+            else:
+                delay = min(retry_delay, self.online_maintenance_interval)
+                retry_delay *= 2
+
+
+    async def poll_server_metrics(self):
+        """Polls the running server's status over RCON every
+           rcon_poll_interval seconds, appending player count, uptime, and
+           FPS to self.server_metrics. Runs until cancelled.
+        """
+        logging.debug('async method: poll_server_metrics')
+        if not self.config.get('enable_rcon', True) or self.rcon_poll_interval <= 0:
+            return
+        port = int(self.config.get('server_base_port', 64090)) + 4
+        host = self.config.get('rcon_host', self.config.get('bind_ip') or '127.0.0.1')
+        rcon = SmssRcon(host, port, self.hosting_config['http_password'],
+                        timeout=float(self.config.get('rcon_timeout', 5)))
+        try:
+            while True:
+                await asyncio.sleep(self.rcon_poll_interval)
+                try:
+                    status = await rcon.send(self.config.get('rcon_status_command', 'status'))
+                except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                    # The server doesn't answer until it has finished loading
+                    logging.debug(f'RCON status unavailable: {e}')
+                    continue
+                except Exception as e:
+                    logging.debug(f'RCON status failed: {e}')
+                    continue
+                metrics = self.parse_server_status(status)
+                self.server_metrics.append(metrics)
+                logging.debug(f'Server metrics: {metrics}')
+        finally:
+            await rcon.close()
+
 
-    async def run(self, cmd):
-        """Leverage asyncio to execute commands
+    async def prefetch_mod_batches(self, batches):
+        """Downloads batches of Workshop mods, one SteamCMD process per
+           batch, logging progress as each item finishes
+
+        Args:
+            batches (list): lists of mod ids, one list per SteamCMD process
+
+        Returns:
+            list: mod ids which failed to download
+        """
+        logging.debug('async method: prefetch_mod_batches')
+        total = sum(len(batch) for batch in batches)
+        downloaded = list()
+        failed = list()
+
+        def track_progress(line):
+            success = re.search(r'Success\. Downloaded item (\d+)', line)
+            failure = re.search(r'ERROR! Download item (\d+) failed', line)
+            if success:
+                downloaded.append(success.group(1))
+                logging.info(f'Prefetched mod {success.group(1)} ({len(downloaded) + len(failed)}/{total})')
+            elif failure:
+                failed.append(failure.group(1))
+                logging.info(f'Failed to prefetch mod {failure.group(1)} ({len(downloaded) + len(failed)}/{total})')
+
+        commands = list()
+        for batch in batches:
+            items = ' '.join(f'+workshop_download_item 299740 {mod_id}' for mod_id in batch)
+            commands.append(f'"{self.steamcmd}" +force_install_dir "{self.miscreated_server_path}" '
+                            f'+login anonymous {items} +quit')
+        await asyncio.gather(*(self.run(cmd, deque(maxlen=self.recent_output.maxlen), track_progress)
+                               for cmd in commands))
+
+        # Items SteamCMD never reported on are treated as failures too
+        all_ids = [mod_id for batch in batches for mod_id in batch]
+        return [mod_id for mod_id in all_ids if mod_id not in downloaded]
+
+
+    async def read_stream(self, stream, name, recent_output, on_line=None):
+        """Reads a process pipe line by line into the output log and a
+           recent output ring buffer
+
+        Args:
+            stream (asyncio.StreamReader): stdout or stderr of a process
+            name (string): stream name used to tag each line
+            recent_output (deque): ring buffer of recent lines
+            on_line (function): optional callback receiving each line
+        """
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            line = line.decode(errors='replace').rstrip()
+            recent_output.append(f'[{name}] {line}')
+            self.output_log.info(f'[{name}] {line}')
+            logging.debug(f'[{name}] {line}')
+            if on_line:
+                on_line(line)
+
+
+    async def run(self, cmd, recent_output=None, on_line=None):
+        """Leverage asyncio to execute commands. Output is streamed to the
+           output log as it is produced rather than held until exit.
 
         Args:
             cmd (string): preformatted commandline command to be executed
+            recent_output (deque): ring buffer for the most recent output
+                                   lines; defaults to self.recent_output
+            on_line (function): optional callback receiving each output line
+
+        Returns:
+            int: the exit code of the command
         """
         logging.debug('async method: run')
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE)
-
-        stdout, stderr = await proc.communicate()
+        if recent_output is None:
+            recent_output = self.recent_output
+        recent_output.clear()
+        self.output_log.info(f'[{cmd!r} started]')
+        with tracer.span('subprocess', cmd=cmd) as span:
+            proc = await asyncio.create_subprocess_shell(
+                cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                limit=1024 * 1024)
+
+            await asyncio.gather(
+                self.read_stream(proc.stdout, 'stdout', recent_output, on_line),
+                self.read_stream(proc.stderr, 'stderr', recent_output, on_line))
+            await proc.wait()
+            span['exit_code'] = proc.returncode
 
         logging.debug(f'[{cmd!r} exited with {proc.returncode}]')
-        if stdout:
-            logging.debug(f'[stdout]\n{stdout.decode()}')
-        if stderr:
-            logging.debug(f'[stderr]\n{stderr.decode()}')
+        self.output_log.info(f'[{cmd!r} exited with {proc.returncode}]')
+        if proc.returncode:
+            logging.info(f'Process exited with code {proc.returncode}. Most recent output:')
+            for line in recent_output:
+                logging.info(line)
+        return proc.returncode
+
+
+    async def run_server(self, server_cmd, summary=None):
+        """Starts the server process first and prints the server start
+           summary once the mod titles have been looked up, so Workshop
+           lookups never delay the server coming online. Server metrics are
+           polled over RCON, and online database maintenance runs, until the
+           server exits.
+
+        Args:
+            server_cmd (string): preformatted server commandline
+            summary (dictionary): values for get_start_server_message, less
+                                  the mod titles; if None nothing is printed
+
+        Returns:
+            int: the exit code of the server process
+        """
+        logging.debug('async method: run_server')
+        server = asyncio.create_task(self.run(server_cmd))
+        metrics = asyncio.create_task(self.poll_server_metrics())
+        maintenance = asyncio.create_task(self.maintain_database())
+        loop = asyncio.get_running_loop()
+        try:
+            if summary is not None:
+                try:
+                    summary['mods'] = await loop.run_in_executor(None, self.get_mod_titles)
+                except Exception as e:
+                    logging.debug(e)
+                    summary['mods'] = ', '.join(str(mod) for mod in self.mod_ids) or '<none>'
+                print(self.get_start_server_message().format(**summary))
+            return await server
+        finally:
+            metrics.cancel()
+            maintenance.cancel()
+            await asyncio.gather(metrics, maintenance, return_exceptions=True)
         
 
     def add_clan_members_for_timer_resets(self):
-        """Adds clan members to base, tent, and vehicle exclusion lists
+        """Resolves the configured owners and clan members into the base,
+           tent, and vehicle reset AccountID sets
         """
         logging.debug('method: add_clan_members_for_timer_resets')
-        if self.reset_base_clan_ids:
-            for steam_id in self.get_clan_members(self.reset_base_clan_ids):
-                self.reset_base_owner_ids.append(steam_id)
+        members = self.get_timer_reset_members()
+        self.reset_base_account_ids = members['base']
+        self.reset_tent_account_ids = members['tent']
+        self.reset_vehicle_account_ids = members['vehicle']
 
-        if self.reset_tent_clan_ids:
-            for steam_id in self.get_clan_members(self.reset_tent_clan_ids):
-                self.reset_tent_owner_ids.append(steam_id)
 
-        if self.reset_vehicle_clan_ids:
-            for steam_id in self.get_clan_members(self.reset_vehicle_clan_ids):
-                self.reset_vehicle_owner_ids.append(steam_id)
-    
+    def apply_staged_update(self):
+        """Copies a server update downloaded by prestage_next_session into
+           the Miscreated server directory. The files SteamCMD wrote while
+           staging, and staged files missing from the installation, are
+           copied.
+        """
+        logging.debug('method: apply_staged_update')
+        staged = self.read_staged_build()
+        if staged is None:
+            return
+        staged_build_id, staged_files = staged
+
+        logging.info(f'Applying staged server build {staged_build_id}')
+        copied = list()
+        for relative_path in self.get_staging_files():
+            source = self.staging_path / relative_path
+            target = self.miscreated_server_path / relative_path
+            if relative_path not in staged_files and target.exists():
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(source, target)
+            copied.append(relative_path)
+
+        # The copied files are an intended change, not drift
+        self.record_install_manifest(copied)
+
+        self.config['server_build_id'] = staged_build_id
+        os.remove(self.staged_build_file)
+
                 
     def calc_distance(self, x1, y1, x2, y2):
         """Calculates the distance between two objects on a plane
@@ -145,6 +1097,46 @@ class SmssConfig:
         self.temp_path.mkdir(parents=True, exist_ok=True)
         
         
+    @contextmanager
+    def database_session(self, pragmas=None, begin='BEGIN'):
+        """Opens one connection to the Miscreated database which is used by
+           every query made inside the with block. All statements run in a
+           single transaction which is committed when the block exits or
+           rolled back if it raises. Nested sessions reuse the open
+           connection.
+
+        Args:
+            pragmas (dictionary): pragmas for the connection; defaults to
+                                  self.database_pragmas
+            begin (string): statement starting the transaction
+
+        Yields:
+            sqlite3.Connection: the shared database connection
+        """
+        import sqlite3
+
+        if self.db_connection is not None:
+            yield self.db_connection
+            return
+
+        logging.debug('Opening database session')
+        with closing(sqlite3.connect(self.miscreated_server_db, isolation_level=None)) as conn:
+            for pragma, value in (self.database_pragmas if pragmas is None else pragmas).items():
+                conn.execute(f'PRAGMA {pragma}={value}')
+            conn.execute(begin)
+            self.db_connection = conn
+            try:
+                yield conn
+            except Exception:
+                logging.info('Rolling back database changes')
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                self.db_connection = None
+
+
     def database_tricks(self):
         """Method used to bundle other methods which massage the database
         """
@@ -153,14 +1145,162 @@ class SmssConfig:
         if not os.path.exists(self.miscreated_server_db):
             return
         
-        self.grant_guides_in_db()
-        self.add_clan_members_for_timer_resets()
-        self.reset_base_timers()
-        self.reset_tent_timers()
-        self.quick_vehicle_despawn()
-        self.reset_vehicle_timers()
+        self.reset_counts = dict(base=0, tent=0, vehicle=0)
+        try:
+            with self.database_session():
+                self.grant_guides_in_db()
+                self.add_clan_members_for_timer_resets()
+                self.reset_base_timers()
+                self.reset_tent_timers()
+                self.quick_vehicle_despawn()
+                self.reset_vehicle_timers()
+        except Exception:
+            # The session rolled back, so none of the counted resets happened
+            self.reset_counts = dict(base=0, tent=0, vehicle=0)
+            raise
         
 
+    def download_file(self, url, file_name):
+        """Streams a download to disk, resuming a partial download with an
+           HTTP Range request and reporting progress and throughput
+
+        Args:
+            url (string): URL to download
+            file_name (Path): where the download is written
+        """
+        logging.debug('method: download_file')
+        offset = file_name.stat().st_size if file_name.exists() else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        timeout = float(self.config.get('download_timeout', 30))
+
+        with tracer.span('download', url=url) as span, \
+             self.http.request('GET', url, headers=headers, stream=True, timeout=timeout) as response:
+            if offset and response.status_code == 416:
+                logging.debug('Download already complete')
+                return
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                logging.info('Server does not support resuming; restarting download')
+                offset = 0
+            elif offset:
+                logging.info(f'Resuming download at {offset} bytes')
+
+            total = int(response.headers.get('Content-Length', 0)) + offset
+            received = offset
+            start_time = last_report = time.perf_counter()
+            with open(file_name, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+                    received += len(chunk)
+                    now = time.perf_counter()
+                    if now - last_report >= 1 or received == total:
+                        last_report = now
+                        rate = (received - offset) / max(now - start_time, 1e-6) / 1024 / 1024
+                        progress = f'{received * 100 / total:.0f}%' if total else f'{received} bytes'
+                        logging.info(f'Downloaded {progress} at {rate:.2f} MB/s')
+
+            span['bytes'] = received - offset
+
+        if total and received != total:
+            raise IOError(f'Download incomplete: {received} of {total} bytes')
+
+
+    def extract_archive(self, zip_file, destination):
+        """Extracts a zip archive in a single streaming pass. Member CRCs are
+           checked as each member is read.
+
+        Args:
+            zip_file (Path): zip archive
+            destination (Path): directory the archive is extracted into
+        """
+        import zipfile
+
+        logging.debug('method: extract_archive')
+        destination = Path(destination).resolve()
+        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+            for member in zip_ref.infolist():
+                target = (destination / member.filename).resolve()
+                if destination not in target.parents and target != destination:
+                    raise zipfile.BadZipFile(f'Unsafe path in archive: {member.filename}')
+                if member.is_dir():
+                    target.mkdir(parents=True, exist_ok=True)
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with zip_ref.open(member) as source, open(target, 'wb') as f:
+                    shutil.copyfileobj(source, f, 1024 * 1024)
+
+
+    def find_objects_near_bases(self, bases, objects):
+        """Finds the objects within BASE_RADIUS of any of the passed bases
+           using a spatial grid index over the objects.
+
+        Args:
+            bases (list): result set rows of (AccountID, PosX, PosY)
+            objects (list): result set rows of (id, PosX, PosY)
+
+        Returns:
+            list: unique ids of objects near the bases
+        """
+        reset_objects = dict()
+        grid = self.get_grid_index(objects)
+
+        for base in bases:
+            x1 = base[1]
+            y1 = base[2]
+            for this_object in self.get_nearby_objects(grid, x1, y1):
+                x2 = this_object[1]
+                y2 = this_object[2]
+                if self.calc_distance(x1, y1, x2, y2) <= BASE_RADIUS:
+                    reset_objects[this_object[0]] = True
+
+        return list(reset_objects)
+
+
+    def find_objects_near_bases_numpy(self, bases, objects):
+        """Finds the objects within BASE_RADIUS of any of the passed bases
+           by computing distances in broadcast blocks of bases. The block size
+           keeps the temporary arrays under distance_memory_budget_mb.
+
+        Args:
+            bases (list): result set rows of (AccountID, PosX, PosY)
+            objects (list): result set rows of (id, PosX, PosY)
+
+        Returns:
+            list: unique ids of objects near the bases, or None if numpy is
+                  not installed
+        """
+        try:
+            import numpy
+        except ImportError:
+            logging.info('numpy is not installed; using the grid engine')
+            return None
+
+        if not bases or not objects:
+            return list()
+
+        base_x = numpy.array([base[1] for base in bases], dtype=numpy.float64)
+        base_y = numpy.array([base[2] for base in bases], dtype=numpy.float64)
+        object_x = numpy.array([this_object[1] for this_object in objects], dtype=numpy.float64)
+        object_y = numpy.array([this_object[2] for this_object in objects], dtype=numpy.float64)
+
+        # Each block holds about three float64 temporaries of
+        # (block rows x object count) at once
+        budget = int(float(self.distance_memory_budget_mb) * 1024 * 1024)
+        block_rows = max(1, budget // (3 * 8 * len(objects)))
+
+        near = numpy.zeros(len(objects), dtype=bool)
+        for start in range(0, len(bases), block_rows):
+            dx = object_x[numpy.newaxis, :] - base_x[start:start + block_rows, numpy.newaxis]
+            dy = object_y[numpy.newaxis, :] - base_y[start:start + block_rows, numpy.newaxis]
+            dx *= dx
+            dy *= dy
+            dx += dy
+            numpy.sqrt(dx, out=dx)
+            near |= (dx <= BASE_RADIUS).any(axis=0)
+
+        return [objects[i][0] for i in numpy.flatnonzero(near)]
+
+
     def get_bases_sql(self):
         """SQL command to look up all bases
 
@@ -168,7 +1308,7 @@ class SmssConfig:
             string: SQL command
         """
         sql = """
-            SELECT (AccountID + 76561197960265728) AS Owner,
+            SELECT AccountID,
                 ROUND(PosX,5) AS PosX,
                 ROUND(PosY,5) AS PosY
             FROM Structures
@@ -177,21 +1317,79 @@ class SmssConfig:
         return sql
 
 
-    def get_clan_members(self, clan_ids):
-        """Query the database for members of a clan
+    def get_database_size(self):
+        """Returns the size of the server database including its write-ahead
+           log
+
+        Returns:
+            int: size of the database in bytes, or None if it does not exist
+        """
+        if not os.path.exists(self.miscreated_server_db):
+            return None
+        wal_file = Path(f'{self.miscreated_server_db}-wal')
+        wal_size = os.path.getsize(wal_file) if wal_file.exists() else 0
+        return os.path.getsize(self.miscreated_server_db) + wal_size
+
+
+    def get_expected_uptime(self):
+        """Works out how long the server is expected to run before it shuts
+           itself down, from sv_maxuptime and schedule_shutdown_utc.
 
         Returns:
-            list: clan member ids
+            float: expected uptime in seconds, or None if unknown
         """
-        logging.debug('method: get_clan_members')
-        sql = """SELECT (AccountID + 76561197960265728) AS SteamID
-                 FROM ClanMembers WHERE ClanID IN ({})"""
-        sql = sql.format(', '.join(str(t) for t in clan_ids))
-        result = self.get_result_set(sql)
-        member_ids = list()
-        for record in result:
-            member_ids.append(record[0])
-        return member_ids
+        candidates = list()
+        try:
+            candidates.append(float(self.hosting_config.get('sv_maxuptime')) * 3600)
+        except (TypeError, ValueError):
+            pass
+
+        shutdown_hours = self.hosting_config.get('schedule_shutdown_utc', [])
+        if not isinstance(shutdown_hours, list):
+            shutdown_hours = [shutdown_hours]
+        now = datetime.now(timezone.utc)
+        for hour in shutdown_hours:
+            try:
+                shutdown = now.replace(hour=int(hour), minute=0, second=0, microsecond=0)
+            except (TypeError, ValueError):
+                continue
+            if shutdown <= now:
+                shutdown += timedelta(days=1)
+            candidates.append((shutdown - now).total_seconds())
+
+        return min(candidates) if candidates else None
+
+
+    def get_grid_cell(self, x, y):
+        """Returns the spatial grid cell containing a position. Cells are
+           BASE_RADIUS meters wide, so every object within BASE_RADIUS of a
+           position lies in that position's cell or an adjacent one.
+
+        Args:
+            x (float): X position value
+            y (float): Y position value
+
+        Returns:
+            tuple: (column, row) of the grid cell
+        """
+        return (math.floor(x / BASE_RADIUS), math.floor(y / BASE_RADIUS))
+
+
+    def get_grid_index(self, objects):
+        """Buckets objects into a uniform spatial grid so proximity lookups
+           only need to look at neighbouring cells.
+
+        Args:
+            objects (list): result set rows of (id, PosX, PosY)
+
+        Returns:
+            dictionary: grid cell tuples mapped to lists of result set rows
+        """
+        grid = dict()
+        for this_object in objects:
+            cell = self.get_grid_cell(this_object[1], this_object[2])
+            grid.setdefault(cell, list()).append(this_object)
+        return grid
 
         
     def get_hosting_cvars(self):
@@ -212,29 +1410,140 @@ class SmssConfig:
         return hosting_cfg
 
 
+    def get_install_files(self):
+        """Lists the installed server files covered by the integrity
+           manifest, skipping files and directories the server changes itself
+
+        Returns:
+            list: file paths relative to the Miscreated server directory
+        """
+        install_files = list()
+        for root, dirs, files in os.walk(self.miscreated_server_path):
+            relative_root = Path(root).relative_to(self.miscreated_server_path)
+            dirs[:] = [d for d in dirs if not self.is_integrity_excluded(relative_root / d)]
+            for name in files:
+                relative_path = relative_root / name
+                if not self.is_integrity_excluded(relative_path):
+                    install_files.append(relative_path.as_posix())
+        return install_files
+
+
+    def get_installed_build_id(self):
+        """Reads the installed server build ID from SteamCMD's app manifest
+
+        Returns:
+            int: installed server build ID, or None if unknown
+        """
+        try:
+            with open(self.miscreated_server_manifest) as f:
+                match = re.search(r'"buildid"\s+"(\d+)"', f.read())
+        except OSError as e:
+            logging.debug(e)
+            return None
+        return int(match.group(1)) if match else None
+
+
+    def get_mod_details(self):
+        """Retrieves title, time_updated, and file_size for every mod in
+           self.mod_ids with a single bulk published file details request.
+           Recently fetched details are served from the mod cache; if the
+           request fails the last known details are used.
+
+        Returns:
+            dictionary: mod ids mapped to dictionaries of mod details
+        """
+        logging.debug('method: get_mod_details')
+        mod_ids = [str(mod) for mod in self.mod_ids if str(mod).isdigit()]
+        details = dict()
+        missing = list()
+        for mod_id in mod_ids:
+            cached = self.mod_cache.get(f'details:{mod_id}', max_age=self.mod_details_ttl)
+            if cached:
+                details[mod_id] = cached
+            else:
+                missing.append(mod_id)
+
+        if not missing:
+            return details
+
+        data = {'itemcount': len(missing)}
+        for index, mod_id in enumerate(missing):
+            data[f'publishedfileids[{index}]'] = mod_id
+
+        try:
+            result = self.http.request('POST', self.workshop_details_url, data=data)
+            result.raise_for_status()
+            published_files = result.json().get('response', {}).get('publishedfiledetails', [])
+        except Exception as e:
+            logging.debug(e)
+            logging.debug('Falling back to last known mod details')
+            published_files = list()
+
+        for published_file in published_files:
+            if published_file.get('result') != 1:
+                continue
+            mod_id = str(published_file.get('publishedfileid'))
+            details[mod_id] = {
+                'title': published_file.get('title', mod_id),
+                'time_updated': int(published_file.get('time_updated', 0)),
+                'file_size': int(published_file.get('file_size', 0))}
+            self.mod_cache.set(f'details:{mod_id}', details[mod_id])
+
+        for mod_id in missing:
+            if mod_id not in details:
+                last_known = self.mod_cache.get(f'details:{mod_id}', max_age=float('inf'))
+                if last_known:
+                    details[mod_id] = last_known
+
+        self.mod_cache.save()
+        return details
+
+
     def get_mod_name(self, mod_id):
-        """Retrieves the name of a Steam Workshop mod
+        """Retrieves the name of a Steam Workshop mod, using the mod cache
+           when possible
 
         Args:
-            mod_id (int): Steam Workshop file id
+            mod_id (string): Steam Workshop file id
 
         Returns:
             string: Steam Workshop mod name
         """
-        url="https://steamcommunity.com/sharedfiles/filedetails/?id={}".format(mod_id)
+        title = self.mod_cache.get(f'title:{mod_id}')
+        if title:
+            return title
+
+        from bs4 import BeautifulSoup, SoupStrainer
+
+        url = self.workshop_url.format(mod_id)
         try:
-            reqs = requests.get(url)
-            soup = BeautifulSoup(reqs.text, 'html.parser')
+            reqs = self.http.request('GET', url)
+            # Only the <title> element is needed; skip building the rest of the page
+            soup = BeautifulSoup(reqs.text, 'html.parser', parse_only=SoupStrainer('title'))
             title = soup.find('title').get_text()
         except Exception as e:
+            logging.debug(e)
             return mod_id
         if title.find("Steam Workshop::") >= 0:
             title = title.replace("Steam Workshop::",mod_id + ": ")
+            self.mod_cache.set(f'title:{mod_id}', title)
         else:
             title = mod_id
         return title
 
 
+    def get_mod_time_updated(self, mod_id):
+        """Returns when a Steam Workshop mod was last updated
+
+        Args:
+            mod_id (string): Steam Workshop file id
+
+        Returns:
+            int: Unix timestamp of the last update, or None if unknown
+        """
+        return self.get_mod_details().get(str(mod_id), {}).get('time_updated')
+
+
     def get_mod_titles(self):
         """Returns a list of mod ids and their names, formatted for output in
            the server start summary screen.
@@ -252,65 +1561,124 @@ class SmssConfig:
         if not len(int_mod_ids):
             return "<none>"
 
-        first = True
-        mod_list = ''
-        for mod in self.mod_ids:
-            this_line = ''
-            if not first:
-                this_line = '\n'+' '*20
-            mod_list = mod_list + this_line + self.get_mod_name(mod)
-            first=False
-        return mod_list
+        titles = dict()
+        for mod_id, details in self.get_mod_details().items():
+            titles[mod_id] = f"{mod_id}: {details['title']}"
+
+        # Scrape any mods the bulk request couldn't describe, concurrently
+        # over the pooled HTTP client
+        missing = [str(mod) for mod in int_mod_ids if str(mod) not in titles]
+        if missing:
+            workers = max(1, min(int(self.workshop_workers), len(missing)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for mod_id, title in zip(missing, executor.map(self.get_mod_name, missing)):
+                    titles[mod_id] = title
+            self.mod_cache.save()
 
+        return ('\n'+' '*20).join(titles[str(mod)] for mod in int_mod_ids)
 
-    def get_result_set(self, sql):
-        """The executes a passed SQL command and returns a result set. If
-           INSERT or UPDATE is detected, a write is assumed and a commit is
-           also performed.
+
+    def get_nearby_objects(self, grid, x, y):
+        """Yields the objects in the grid cells surrounding a position. These
+           are candidates only; callers still need to check the distance.
+
+        Args:
+            grid (dictionary): grid index as returned by get_grid_index
+            x (float): X position value
+            y (float): Y position value
+        """
+        column, row = self.get_grid_cell(x, y)
+        # Two cells either side absorbs float rounding at cell boundaries
+        for this_column in range(column - 2, column + 3):
+            for this_row in range(row - 2, row + 3):
+                yield from grid.get((this_column, this_row), ())
+
+
+    def get_result_set(self, sql, params=()):
+        """The executes a passed SQL command and returns a result set. Inside
+           a database_session() the shared connection and transaction are
+           used and errors are raised so the session rolls back. Otherwise a
+           short-lived connection is opened and, if INSERT or UPDATE is
+           detected, a write is assumed and a commit is also performed. The
+           number of rows changed by the command is kept in self.rows_changed.
 
         Args:
             sql (string): SQL command
+            params (tuple): values bound to the SQL command's placeholders
 
         Returns:
             list: a result set resulting from the execution of the SQL command
         """
+        import sqlite3
+
         if not os.path.exists(self.miscreated_server_db):
             logging.debug('Database not yet created')
             return False
 
         logging.debug(sql)
+        self.rows_changed = 0
+
+        if self.db_connection is not None:
+            with tracer.span('sql', statement=' '.join(sql.split())[:120]) as span:
+                try:
+                    cursor = self.db_connection.execute(sql, params)
+                    result_set = cursor.fetchall()
+                except sqlite3.Error as e:
+                    # Raised for the session to roll back; callers report it
+                    logging.debug(e)
+                    raise
+                span['rows'] = cursor.rowcount if cursor.rowcount >= 0 else len(result_set)
+            self.rows_changed = max(cursor.rowcount, 0)
+            return result_set
 
         # If 'insert ' or 'update ' exist in the sql statement, we're probably
         # doing a database write and will want to commit the changes.
         commit = (sql.lower().find('insert ') >= 0) or \
                  (sql.lower().find('update ') >= 0)
 
-        conn = sqlite3.connect(self.miscreated_server_db)
-        c = conn.cursor()
-        try:
-            results = c.execute(sql)
-            if commit:
-                conn.commit()
-        except sqlite3.Error as e:
-            print(e)
-            return None
-        result_set = list()
-        for result in results.fetchall():
-            result_set.append(result)
+        with tracer.span('sql', statement=' '.join(sql.split())[:120]) as span, \
+             closing(sqlite3.connect(self.miscreated_server_db)) as conn:
+            try:
+                results = conn.execute(sql, params)
+                result_set = results.fetchall()
+                if commit:
+                    conn.commit()
+            except sqlite3.Error as e:
+                print(e)
+                return None
+            span['rows'] = results.rowcount if results.rowcount >= 0 else len(result_set)
+            self.rows_changed = max(results.rowcount, 0)
 
         return result_set
 
 
     def get_server_build_id(self):
+        """Looks up the latest public server build ID, using the build cache
+           when it was looked up recently. If the lookup fails, or in offline
+           mode, the last known build ID is used.
+
+        Returns:
+            int: latest server build ID, or -1 if it has never been retrieved
+        """
+        build_id = self.build_cache.get('302200')
+        if build_id is not None:
+            return build_id
+
         try:
-            result = requests.get('https://api.steamcmd.net/v1/info/302200', timeout=10)
-        except:
-            return -1
-     
-        if result.status_code != 200:
-            return -1
-        app_info = json.loads(result.text)
+            result = self.http.request('GET', 'https://api.steamcmd.net/v1/info/302200')
+            result.raise_for_status()
+            app_info = result.json()
+        except Exception as e:
+            logging.debug(e)
+            build_id = self.build_cache.get('302200', -1, max_age=float('inf'))
+            if build_id != -1:
+                logging.info(f'Using the last known server build {build_id}')
+            return build_id
+
         build_id = app_info.get('data', {}).get('302200', {}).get('depots', {}).get('branches', {}).get('public', {}).get('buildid', -1)
+        if int(build_id) != -1:
+            self.build_cache.set('302200', int(build_id))
+            self.build_cache.save()
         return build_id
 
 
@@ -329,11 +1697,7 @@ class SmssConfig:
         logging.debug('Retrieving first server ID found in the database')
         query = 'SELECT GameServerID FROM Characters ORDER BY CharacterID LIMIT 1'
         try:
-            conn = sqlite3.connect(self.miscreated_server_db)
-            cur = conn.cursor()
-            cur.execute(query)
-            record = cur.fetchone()
-            result = record[0]
+            result = self.get_result_set(query)[0][0]
         except Exception as e:
             logging.debug('Error retrieving first server ID found in the database')
             logging.debug(e)
@@ -342,6 +1706,22 @@ class SmssConfig:
         return result
 
 
+    def get_staging_files(self):
+        """Lists the files in the staging directory with their size and
+           modification time, leaving out the staged build marker
+
+        Returns:
+            dictionary: paths relative to the staging directory mapped to
+                        (size, mtime_ns) tuples
+        """
+        staging_files = dict()
+        for source in self.staging_path.rglob('*'):
+            if source.is_file() and not source.name.startswith(self.staged_build_file.name):
+                stat = source.stat()
+                staging_files[source.relative_to(self.staging_path).as_posix()] = (stat.st_size, stat.st_mtime_ns)
+        return staging_files
+
+
     def get_start_server_message(self):
         """Returns a block of text to be used for the server start summary
            screen
@@ -359,6 +1739,7 @@ class SmssConfig:
                   '              [1m[36mMods: [1m[33m{mods}[0m\r\n'\
                   '  [1m[36mGame Ports (UDP): [1m[33m{port}[0m\r\n'\
                   '   [1m[36mRCON Port (TCP): [1m[33m{rcon}[0m\r\n'\
+                  '           [1m[36mStartup: [1m[33m{trace}[0m\r\n'\
                   ''+'═'*78+'\r\n\r\n'\
                   'Launching Miscreated server process ({timestamp})...\r\n'\
                   '╔'+'═'*76+'╗\r\n'\
@@ -382,21 +1763,33 @@ class SmssConfig:
             return
 
         logging.info("{} does not exist".format(self.steamcmd))
-        steamcmd_url = 'https://steamcdn-a.akamaihd.net/client/installer/steamcmd.zip'
+        steamcmd_url = self.config.get('steamcmd_url', 'https://steamcdn-a.akamaihd.net/client/installer/steamcmd.zip')
         steamcmd_zip_file = Path("{}/steamcmd.zip".format(self.temp_path))
+        steamcmd_part_file = Path("{}/steamcmd.zip.part".format(self.temp_path))
 
-        try:
-            logging.info("Attempting SteamCMD download")
-            request.urlretrieve(steamcmd_url, steamcmd_zip_file)
-        except Exception as e:
-            logging.debug(e)
+        if not steamcmd_zip_file.exists():
+            try:
+                logging.info("Attempting SteamCMD download")
+                self.download_file(steamcmd_url, steamcmd_part_file)
+                os.replace(steamcmd_part_file, steamcmd_zip_file)
+            except Exception as e:
+                # The partial download is kept so the next attempt resumes it
+                logging.info("SteamCMD download failed: {}".format(e))
+                return
+
+        if not self.verify_archive(steamcmd_zip_file, self.config.get('steamcmd_sha256')):
+            logging.info("{} is corrupt and will be downloaded again".format(steamcmd_zip_file))
+            os.remove(steamcmd_zip_file)
+            return
 
         try:
             logging.info("Extracting {} archive".format(steamcmd_zip_file))
-            with zipfile.ZipFile(steamcmd_zip_file, 'r') as zip_ref:
-                zip_ref.extractall(self.steamcmd_path)
+            self.extract_archive(steamcmd_zip_file, self.steamcmd_path)
         except Exception as e:
-            logging.debug(e)
+            logging.info("SteamCMD extraction failed: {}".format(e))
+            os.remove(steamcmd_zip_file)
+            if os.path.exists(self.steamcmd):
+                os.remove(self.steamcmd)
 
 
     def get_tents_sql(self):
@@ -415,6 +1808,59 @@ class SmssConfig:
         return sql
 
 
+    def get_timer_reset_members(self):
+        """Resolves the AccountIDs whose bases, tents, and vehicles should be
+           reset. Configured SteamID64 owner ids are converted to AccountIDs
+           and the members of every configured clan are looked up with a
+           single query.
+
+        Returns:
+            dictionary: 'base', 'tent', and 'vehicle' mapped to frozensets of
+                        AccountIDs
+        """
+        logging.debug('method: get_timer_reset_members')
+        categories = {
+            'base': (self.reset_base_owner_ids, self.reset_base_clan_ids),
+            'tent': (self.reset_tent_owner_ids, self.reset_tent_clan_ids),
+            'vehicle': (self.reset_vehicle_owner_ids, self.reset_vehicle_clan_ids)}
+
+        clan_ids = set()
+        for _, category_clan_ids in categories.values():
+            clan_ids.update(int(t) for t in category_clan_ids)
+
+        clan_members = dict()
+        if clan_ids:
+            sql = "SELECT ClanID, AccountID FROM ClanMembers WHERE ClanID IN ({})"
+            with self.database_session():
+                sql = sql.format(self.load_temp_ids('smss_clan_ids', clan_ids))
+                for clan_id, account_id in self.get_result_set(sql) or ():
+                    clan_members.setdefault(clan_id, set()).add(account_id)
+
+        members = dict()
+        for category, (owner_ids, category_clan_ids) in categories.items():
+            account_ids = {int(t) - STEAM_ID64_BASE for t in owner_ids}
+            for clan_id in category_clan_ids:
+                account_ids.update(clan_members.get(int(clan_id), ()))
+            members[category] = frozenset(account_ids)
+        return members
+
+
+    def get_trace_summary(self):
+        """Returns the slowest startup phases traced so far, formatted for
+           output in the server start summary screen.
+
+        Returns:
+            string: startup phases and their durations
+        """
+        phases = sorted(tracer.summary(), key=lambda phase: phase[1], reverse=True)
+        if not phases:
+            return '<none>'
+        lines = [f'{duration:>7.2f}s {"*" if name in self.critical_path else " "} {name}'
+                 for name, duration in phases[:5]]
+        lines.append(f'{tracer.elapsed():>7.2f}s   total (* critical path)')
+        return ('\n'+' '*20).join(lines)
+
+
     def get_vehicles_sql(self):
         """SQL command to look up all vehicles
 
@@ -430,28 +1876,125 @@ class SmssConfig:
         return sql
 
 
-    def grant_guides_in_db(self):
-        """Grants all guides to players.
-        """
-        logging.debug('method: grant_guides_in_db')
-        if not self.config.get('grant_guides', False):
-            return
+    def grant_guides_in_db(self, create_trigger=True):
+        """Grants all guides to players.
+
+        Args:
+            create_trigger (bool): whether the trigger granting guides on
+                                   every character update is recreated too
+
+        Raises:
+            sqlite3.OperationalError: without create_trigger, so online
+                                      maintenance sees a busy database
+        """
+        import sqlite3
+
+        logging.debug('method: grant_guides_in_db')
+        if not self.config.get('grant_guides', False):
+            return
+
+        logging.debug('Granting guides to all players')
+
+        # Statements are run one at a time; executescript() would commit the
+        # surrounding database session
+        statements = (
+            'DROP TRIGGER IF EXISTS grant_all_guides;',
+            'CREATE TRIGGER IF NOT EXISTS grant_all_guides AFTER UPDATE ON Characters BEGIN UPDATE ServerAccountData SET Guide00="-1", Guide01="-1"; END;',
+            'UPDATE ServerAccountData SET Guide00="-1", Guide01="-1";')
+        if not create_trigger:
+            statements = statements[-1:]
+        try:
+            with self.database_session():
+                for sql in statements:
+                    self.get_result_set(sql)
+        except sqlite3.OperationalError as e:
+            if not create_trigger:
+                raise
+            logging.debug(e)
+        except Exception as e:
+            logging.debug(e)
+
+
+    def hash_install_file(self, relative_path):
+        """Hashes the contents of an installed server file
+
+        Args:
+            relative_path (string): path relative to the Miscreated server directory
+
+        Returns:
+            string: hex digest of the file contents
+        """
+        digest = hashlib.sha1()
+        with open(Path(f'{self.miscreated_server_path}/{relative_path}'), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+    def install_drift_detected(self):
+        """Checks the installed server files against the integrity manifest.
+           Files are stat'ed first and only hashed if their size or
+           modification time changed. Files which were touched but still
+           match their hash have their manifest entries refreshed.
+
+        Returns:
+            bool: True if a file is missing or changed, None if there is no
+                  integrity manifest to check against
+        """
+        logging.debug('method: install_drift_detected')
+        try:
+            with open(self.install_manifest_file) as f:
+                manifest = json.load(f)
+        except Exception as e:
+            logging.debug(e)
+            return None
+
+        touched = list()
+
+        def file_drifted(item):
+            relative_path, (size, mtime_ns, digest) = item
+            try:
+                stat = os.stat(Path(f'{self.miscreated_server_path}/{relative_path}'))
+            except OSError:
+                return True
+            if stat.st_size != size:
+                return True
+            if stat.st_mtime_ns == mtime_ns:
+                return False
+            if self.hash_install_file(relative_path) != digest:
+                return True
+            touched.append(relative_path)
+            return False
+
+        with ThreadPoolExecutor(max_workers=self.integrity_workers) as executor:
+            drifted = [path for path, changed in zip(manifest, executor.map(file_drifted, manifest.items())) if changed]
+
+        for relative_path in drifted:
+            logging.info(f'Installed server file changed or missing: {relative_path}')
+        if touched:
+            # Record the new modification times so these aren't hashed again next start
+            self.record_install_manifest(touched)
+        return bool(drifted)
+
+
+    def is_integrity_excluded(self, relative_path):
+        """Checks a file or directory name against the integrity_exclude
+           patterns
 
-        logging.debug('Granting guides to all players')
+        Args:
+            relative_path (Path): path relative to the Miscreated server directory
 
-        sql = """
-        DROP TRIGGER IF EXISTS grant_all_guides;
-        CREATE TRIGGER IF NOT EXISTS grant_all_guides AFTER UPDATE ON Characters BEGIN UPDATE ServerAccountData SET Guide00="-1", Guide01="-1"; END; UPDATE ServerAccountData SET Guide00="-1", Guide01="-1";
+        Returns:
+            bool: True if the path is not covered by the integrity manifest
         """
-        try:
-            conn = sqlite3.connect(self.miscreated_server_db)
-            conn.executescript(sql)
-        except Exception as e:
-            logging.debug(e)
+        return any(relative_path.match(pattern) for pattern in self.integrity_exclude)
 
 
     def launch_server(self):
         """Launch a Miscreated server instance
+
+        Returns:
+            int: the exit code of the server process
         """
         logging.debug('method: launch_server')
 
@@ -492,20 +2035,48 @@ class SmssConfig:
         server_cmd = '"{}"'.format(self.miscreated_server_cmd) + ' ' + server_options
     
         timestamp = str(date.today()) + ', ' + str(datetime.now().strftime("%I:%M %p"))
-        message = self.get_start_server_message().format(
+        summary = dict(
             date=date.today(),
             map=miscreated_map,
-            mods=self.get_mod_titles(),
             port=", ".join([str(i) for i in range(base_port, base_port+4)]),
             rcon=base_port+4,
             sv_servername=sv_servername,
-            timestamp=timestamp)
-        print(message)
+            timestamp=timestamp,
+            trace=self.get_trace_summary())
+        self.write_trace()
         logging.debug(server_cmd)
         logging.debug('Server started: ' + timestamp)
-        asyncio.run(self.run(server_cmd))
+        self.start_prestage()
+        if self.config.get('launch_server_first', True):
+            exit_code = asyncio.run(self.run_server(server_cmd, summary))
+        else:
+            print(self.get_start_server_message().format(mods=self.get_mod_titles(), **summary))
+            exit_code = asyncio.run(self.run_server(server_cmd))
         timestamp = str(date.today()) + ', ' + str(datetime.now().strftime("%I:%M %p"))
         logging.debug('Server closed: ' + timestamp)
+        self.wait_for_prestage()
+        return exit_code
+
+
+    def load_temp_ids(self, table, ids):
+        """Loads ids into a temporary table with executemany so bulk
+           statements can join against it instead of embedding every id in
+           the SQL text. The table only lives as long as the surrounding
+           database_session().
+
+        Args:
+            table (string): name of the temporary table
+            ids (iterable): integer ids to be loaded
+
+        Returns:
+            string: SQL subquery selecting the loaded ids
+        """
+        with self.database_session() as conn:
+            conn.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY)')
+            conn.execute(f'DELETE FROM temp.{table}')
+            conn.executemany(f'INSERT OR IGNORE INTO temp.{table} (id) VALUES (?)',
+                             ((int(t),) for t in ids))
+        return f'SELECT id FROM temp.{table}'
 
 
     def mod_handler(self):
@@ -528,6 +2099,47 @@ class SmssConfig:
         return this_steam_ugc, mod_ids
 
 
+    def new_session(self):
+        """Refreshes the settings which change for every server session when
+           the same SmssConfig is reused by the supervisor
+        """
+        logging.debug('method: new_session')
+        override_sv_maxuptime = self.override_sv_maxuptime()
+        if override_sv_maxuptime:
+            self.hosting_config['sv_maxuptime'] = override_sv_maxuptime
+
+
+    def online_database_tricks(self):
+        """Runs the database tricks which are safe while the server is
+           running. Vehicles are not despawned and the guides trigger is not
+           recreated. Each trick is its own short transaction, waits at most
+           online_busy_timeout_ms for the game's write lock, and is
+           interrupted once the run exceeds online_maintenance_budget_ms. A
+           run which runs out of time or finds the database busy resumes
+           with the same trick next time; an interrupted trick is skipped.
+
+        Returns:
+            bool: False if the run stopped because the database was busy
+        """
+        logging.debug('method: online_database_tricks')
+        if not os.path.exists(self.miscreated_server_db):
+            return True
+
+        steps = (
+            lambda: self.grant_guides_in_db(create_trigger=False),
+            self.add_clan_members_for_timer_resets,
+            self.reset_base_timers,
+            self.reset_tent_timers,
+            self.reset_vehicle_timers)
+        # Resets made while the server runs aren't counted in the run journal
+        reset_counts, self.reset_counts = self.reset_counts, dict(base=0, tent=0, vehicle=0)
+        try:
+            return self.run_online_steps(steps)
+        finally:
+            logging.debug(f'Online database maintenance resets: {self.reset_counts}')
+            self.reset_counts = reset_counts
+
+
     def override_sv_maxuptime(self):
         if not self.sv_maxuptime_range.get('enabled', False):
             logging.debug(f'self.sv_maxuptime_range: {self.sv_maxuptime_range}')
@@ -547,67 +2159,247 @@ class SmssConfig:
         return round(SystemRandom().uniform(min_val, max_val), 1)
 
 
-    def prepare_server(self):
-        """Method to bundle other methods to ensure server is ready to run
+    def parse_server_status(self, status):
+        """Extracts the player count, uptime, and FPS from the output of the
+           RCON status command
+
+        Args:
+            status (string): status command output
+
+        Returns:
+            dictionary: time of the poll, players, max_players, uptime in
+                        seconds, and fps; values missing from the output are None
         """
-        logging.debug('method: prepare_server')
-        self.remove_server_mods()
-        self.get_steam()
-        self.validate_miscreated_server()
-        
-        
-    def remove_server_mods(self):
-        """Remove the mods directory if it exists. This is done to ensure that
-           the latest version of the mods are installed in the Miscreated
-           directory. We do this because Steam doesn't properly validate and
-           refresh the mods; this does not force the mods to redownload each
-           time as they are cached by steamcmd.
-        """
-        logging.debug('method: remove_server_mods')
-        mods_dir = Path('{}/Mods'.format(self.miscreated_server_path))
-        if os.path.exists(mods_dir):
-            logging.debug('Removing mods directory to refresh mods')
-            try:
-                shutil.rmtree(mods_dir, ignore_errors=True)
-            except OSError as e:
-                logging.debug("Error: {} : {}".format(mods_dir, e.strerror))
+        metrics = dict(time=time.time(), players=None, max_players=None, uptime=None, fps=None)
+        players = re.search(r'players:\s*(\d+)\s*/\s*(\d+)', status, re.IGNORECASE)
+        if players:
+            metrics['players'], metrics['max_players'] = int(players.group(1)), int(players.group(2))
+        uptime = re.search(r'uptime:\s*([\d:]+)', status, re.IGNORECASE)
+        if uptime:
+            metrics['uptime'] = functools.reduce(lambda total, part: total * 60 + int(part or 0),
+                                                 uptime.group(1).split(':'), 0)
+        fps = re.search(r'fps:\s*([\d.]+)', status, re.IGNORECASE)
+        if fps:
+            metrics['fps'] = float(fps.group(1))
+        return metrics
+
+
+    def prefetch_mods(self):
+        """Downloads the configured Workshop mods with SteamCMD before the
+           server starts, so the server doesn't download them one after
+           another while players wait. Mods already downloaded at their
+           current Workshop time_updated are skipped. Every download is
+           batched into one SteamCMD process; prefetch_workers splits them
+           across more, which SteamCMD only supports with separate installs.
+        """
+        logging.debug('method: prefetch_mods')
+        if not self.config.get('prefetch_mods', True) or self.http.offline:
+            return
+        details = self.get_mod_details()
+        content_path = Path(f'{self.miscreated_server_path}/steamapps/workshop/content/299740')
+        mod_ids = list()
+        for mod_id in (str(mod) for mod in self.mod_ids if str(mod).isdigit()):
+            time_updated = details.get(mod_id, {}).get('time_updated')
+            prefetched = self.mod_cache.get(f'prefetched:{mod_id}', max_age=float('inf'))
+            if time_updated is None or prefetched != time_updated or not (content_path / mod_id).exists():
+                mod_ids.append(mod_id)
+        if not mod_ids:
+            logging.debug('Every mod has already been prefetched')
+            return
 
+        workers = max(1, min(int(self.config.get('prefetch_workers', 1)), len(mod_ids)))
+        batches = [mod_ids[i::workers] for i in range(workers)]
+        logging.info(f'Prefetching {len(mod_ids)} mods with {workers} SteamCMD process(es)...')
+        start_time = time.perf_counter()
+        failed = asyncio.run(self.prefetch_mod_batches(batches))
+        logging.info(f'Prefetched {len(mod_ids) - len(failed)} of {len(mod_ids)} mods '
+                     f'in {time.perf_counter() - start_time:.1f}s')
+        if failed:
+            logging.info(f'The server will download these mods itself: {", ".join(failed)}')
+
+        for mod_id in mod_ids:
+            time_updated = details.get(mod_id, {}).get('time_updated')
+            if mod_id not in failed and time_updated is not None:
+                self.mod_cache.set(f'prefetched:{mod_id}', time_updated)
+        self.mod_cache.save()
+
+
+    def prestage_next_session(self):
+        """Prepares as much of the next session as possible while the
+           server is still running: the current build ID is checked, any
+           server update is downloaded into the staging directory, and the
+           mod metadata cache and downloaded mods are refreshed.
+        """
+        logging.debug('method: prestage_next_session')
+        self.get_mod_details()
+        self.prefetch_mods()
 
-    def replace_config_lines(self, filename, variable, value):
-        """This method replaces all matching lines in config files having the
-           format "variable=value"
+        current_server_build_id = int(self.get_server_build_id())
+        if current_server_build_id in (-1, self.get_installed_build_id()):
+            return
+
+        logging.info(f'Staging server build {current_server_build_id}')
+        self.staging_path.mkdir(parents=True, exist_ok=True)
+        before = self.get_staging_files()
+        stage_cmd = f'"{self.steamcmd}" +login anonymous +force_install_dir "{self.staging_path}" '\
+                    '+app_update 302200 +quit'
+        exit_code = asyncio.run(self.run(stage_cmd, deque(maxlen=self.recent_output.maxlen)))
+        if exit_code != 0:
+            return
+
+        # Files written by this run, plus those of a stage not yet applied
+        changed = {path for path, stat in self.get_staging_files().items() if before.get(path) != stat}
+        staged = self.read_staged_build()
+        if staged is not None:
+            changed.update(staged[1])
+        temp_file = Path(f'{self.staged_build_file}.tmp')
+        with open(temp_file, 'w') as f:
+            json.dump({'build_id': current_server_build_id, 'files': sorted(changed)}, f)
+        os.replace(temp_file, self.staged_build_file)
+
+
+    def prestage_worker(self, delay):
+        """Waits until shortly before the expected shutdown, then pre-stages
+           the next session unless the server has already exited
 
         Args:
-            filename (string): filesystem path to a file
-            variable (string): variable name to be added or updated with a new
-                               value
-            value (string): the new value for the variable
+            delay (float): seconds to wait before pre-staging
         """
-        logging.debug('method: replace_config_lines :: {}'.format(variable))
-        # We haven't replaced anything yet so this value is False
-        replaced = False
+        if self.prestage_cancel.wait(delay):
+            return
+        try:
+            self.prestage_next_session()
+        except Exception as e:
+            logging.info(f'Pre-staging failed: {e}')
 
-        # This rewrites the file making subsitutions where needed
-        if os.path.exists(filename):
-            for line in fileinput.input([filename], inplace=True):
-                if line.strip().lower().startswith('{}='.format(variable.lower())):
-                    line = '{}={}\n'.format(variable, value)
-                    replaced = True
-                sys.stdout.write(line)
 
-        # if no lines were replaced open the file and write out the variable/value pair
-        if not replaced:
+    def read_staged_build(self):
+        """Reads the staged build marker written by prestage_next_session
+
+        Returns:
+            tuple: the staged build ID and the set of staged files SteamCMD
+                   wrote, or None if no build is staged
+        """
+        try:
+            with open(self.staged_build_file) as f:
+                staged = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if isinstance(staged, int):
+            # Markers from before files were tracked hold only the build ID
+            return staged, set(self.get_staging_files())
+        return int(staged['build_id']), set(staged['files'])
+
+
+    def record_install_manifest(self, relative_paths=None):
+        """Records the size, modification time, and hash of every installed
+           server file in the integrity manifest
+
+        Args:
+            relative_paths (iterable): only update the entries of these
+                                       files in an existing manifest
+        """
+        logging.debug('method: record_install_manifest')
+        manifest = dict()
+        if relative_paths is None:
+            install_files = self.get_install_files()
+        else:
             try:
-                with open(filename, 'r') as f:
-                    for line in f:
-                        pass
-            except:
-                line = ''
-            file_name = open(filename, 'a+')
-            if not line == "\n":
-                file_name.write('\n')
-            file_name.write('{}={}'.format(variable, value))
-            file_name.close
+                with open(self.install_manifest_file) as f:
+                    manifest = json.load(f)
+            except Exception as e:
+                # The next validation records a full manifest
+                logging.debug(e)
+                return
+            install_files = [path for path in relative_paths if not self.is_integrity_excluded(Path(path))]
+
+        def hash_file(relative_path):
+            # Files may vanish while the directory is walked
+            try:
+                stat = os.stat(Path(f'{self.miscreated_server_path}/{relative_path}'))
+                return [stat.st_size, stat.st_mtime_ns, self.hash_install_file(relative_path)]
+            except FileNotFoundError:
+                logging.debug(f'{relative_path} vanished while recording the integrity manifest')
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.integrity_workers) as executor:
+            entries = list(executor.map(hash_file, install_files))
+
+        for relative_path, entry in zip(install_files, entries):
+            if entry is None:
+                manifest.pop(relative_path, None)
+            else:
+                manifest[relative_path] = entry
+
+        temp_file = Path(f'{self.install_manifest_file}.tmp')
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_file, self.install_manifest_file)
+
+
+    def record_session(self, prepare_time, start_time, db_size, uptime, exit_code):
+        """Appends the session which just ended to the run journal. Downtime
+           is measured from the end of the previous journaled session to the
+           launch of this one.
+
+        Args:
+            prepare_time (float): when preparing the session started
+            start_time (float): when the server process was launched
+            db_size (int): size of the database at launch, in bytes
+            uptime (float): how long the server process ran, in seconds
+            exit_code (int): exit code of the server process
+        """
+        import sqlite3
+
+        logging.debug('method: record_session')
+        phases = dict()
+        for name, duration in tracer.summary():
+            if name not in ('launch_server', 'write_trace'):
+                phases[name] = round(phases.get(name, 0) + duration, 3)
+
+        session = dict(
+            started_at=start_time,
+            ended_at=start_time + uptime,
+            build_id=self.get_installed_build_id(),
+            mods=json.dumps([str(mod) for mod in self.mod_ids]),
+            prepare_time=start_time - prepare_time,
+            phases=json.dumps(phases),
+            db_size=db_size,
+            bases_reset=self.reset_counts['base'],
+            tents_reset=self.reset_counts['tent'],
+            vehicles_reset=self.reset_counts['vehicle'],
+            uptime=uptime,
+            exit_code=exit_code)
+        try:
+            with closing(open_journal(self.journal_file)) as conn, conn:
+                previous = conn.execute('SELECT MAX(ended_at) FROM sessions').fetchone()[0]
+                session['downtime'] = start_time - previous if previous else None
+                conn.execute("""
+                    INSERT INTO sessions (started_at, ended_at, build_id, mods, downtime,
+                        prepare_time, phases, db_size, bases_reset, tents_reset,
+                        vehicles_reset, uptime, exit_code)
+                    VALUES (:started_at, :ended_at, :build_id, :mods, :downtime,
+                        :prepare_time, :phases, :db_size, :bases_reset, :tents_reset,
+                        :vehicles_reset, :uptime, :exit_code)
+                    """, session)
+        except sqlite3.Error as e:
+            logging.info(f'Could not record this session in the run journal: {e}')
+
+
+    def replace_config_lines(self, filename, values):
+        """This method replaces all matching lines in config files having the
+           format "variable=value", appending variables which aren't set yet.
+           The file is read once and only rewritten if it changes.
+
+        Args:
+            filename (string): filesystem path to a file
+            values (dictionary): variable names mapped to their new values
+        """
+        logging.debug('method: replace_config_lines :: {}'.format(', '.join(values)))
+        config_file = SmssConfigFile(filename)
+        for variable, value in values.items():
+            config_file.set(variable, value)
+        config_file.save()
 
                 
     def reset_base_timers(self):
@@ -616,31 +2408,26 @@ class SmssConfig:
         if self.config.get('reset_all_bases', False):
             sql = "UPDATE Structures SET AbandonTimer=2419200 WHERE ClassName='PlotSign';"
             self.get_result_set(sql)
+            self.reset_counts['base'] += self.rows_changed
             return
         
-        if not self.reset_base_owner_ids:
+        if not self.reset_base_account_ids:
             return
-        
-        bases = self.get_result_set(self.get_bases_sql())
-
-        account_ids = list()
-        for base in bases:
-            if base[0] in self.reset_base_owner_ids:
-                account_ids.append(int(base[0]) - 76561197960265728)
 
-        if len(account_ids):
-            logging.debug('Reset bases for AccountIDs: {}'.format(account_ids))
-            sql = "UPDATE Structures SET AbandonTimer=2419200 WHERE ClassName='PlotSign' AND AccountID IN ({});"
-            sql = sql.format(', '.join(str(t) for t in account_ids))
+        logging.debug('Reset bases for AccountIDs: {}'.format(sorted(self.reset_base_account_ids)))
+        sql = "UPDATE Structures SET AbandonTimer=2419200 WHERE ClassName='PlotSign' AND AccountID IN ({});"
+        with self.database_session():
+            sql = sql.format(self.load_temp_ids('smss_account_ids', self.reset_base_account_ids))
             self.get_result_set(sql)
+            self.reset_counts['base'] += self.rows_changed
 
 
-    def reset_base_object_timers(self, objects, owner_ids, update_sql, thing):
+    def reset_base_object_timers(self, objects, account_ids, update_sql, thing):
         """Reset timers bases on passed settings.
 
         Args:
             objects (dictionary): result set of objects to be reset
-            owner_ids (list): 'owner' ids for which objects should be reset
+            account_ids (frozenset): AccountIDs for which objects should be reset
             update_sql (string): SQL command to perform update
             thing (string): the type of object being reset - for logging purposes
         """
@@ -649,26 +2436,76 @@ class SmssConfig:
         if not bases:
             return
 
-        reset_objects = list()
+        owned_bases = [base for base in bases if base[0] in account_ids]
 
-        for base in bases:
-            steam_id = base[0]
-            x1 = base[1]
-            y1 = base[2]
-            if steam_id not in owner_ids:
-                continue
-            for this_object in objects:
-                x2 = this_object[1]
-                y2 = this_object[2]
-                if self.calc_distance(x1, y1, x2, y2) <= 30:
-                    reset_objects.append(this_object[0])
+        reset_objects = None
+        if self.distance_engine == 'numpy':
+            reset_objects = self.find_objects_near_bases_numpy(owned_bases, objects)
+        if reset_objects is None:
+            reset_objects = self.find_objects_near_bases(owned_bases, objects)
 
         if not len(reset_objects):
             return
 
         logging.debug('Reset {} ids: {}'.format(thing, reset_objects))
-        update_sql = update_sql.format(', '.join(str(t) for t in reset_objects))
-        self.get_result_set(update_sql)
+        with self.database_session():
+            update_sql = update_sql.format(self.load_temp_ids('smss_reset_ids', reset_objects))
+            self.get_result_set(update_sql)
+            self.reset_counts[thing] += self.rows_changed
+
+
+    def reset_base_object_timers_rtree(self, objects_sql, account_ids, update_sql, thing):
+        """Reset timers for objects near owned bases without leaving SQLite.
+           Owned bases are loaded into a temporary R*Tree as bounding boxes
+           and a single UPDATE prefilters objects against those boxes before
+           checking the exact distance with calc_distance.
+
+        Args:
+            objects_sql (string): SQL command returning (id, PosX, PosY) rows
+            account_ids (frozenset): AccountIDs for which objects should be reset
+            update_sql (string): SQL command to perform update
+            thing (string): the type of object being reset - for logging purposes
+
+        Returns:
+            bool: False if the R*Tree engine is unavailable in this SQLite build
+        """
+        import sqlite3
+
+        logging.debug('method: reset_base_object_timers_rtree')
+        bases_sql = """
+            INSERT INTO temp.smss_base_rtree (min_x, max_x, min_y, max_y, x, y)
+            SELECT PosX - :radius, PosX + :radius, PosY - :radius, PosY + :radius, PosX, PosY
+            FROM ({bases})
+            WHERE AccountID IN ({owners})
+            """
+        objects_sql = """
+            WITH objects(id, x, y) AS ({objects})
+            SELECT objects.id
+            FROM objects, temp.smss_base_rtree AS bases
+            WHERE bases.min_x <= objects.x AND bases.max_x >= objects.x
+                AND bases.min_y <= objects.y AND bases.max_y >= objects.y
+                AND smss_distance(bases.x, bases.y, objects.x, objects.y) <= :radius
+            """.format(objects=objects_sql)
+        params = {'radius': BASE_RADIUS}
+
+        with self.database_session() as conn:
+            try:
+                conn.create_function('smss_distance', 4, self.calc_distance, deterministic=True)
+                conn.execute('DROP TABLE IF EXISTS temp.smss_base_rtree')
+                conn.execute('CREATE VIRTUAL TABLE temp.smss_base_rtree '
+                             'USING rtree(id, min_x, max_x, min_y, max_y, +x, +y)')
+            except sqlite3.Error as e:
+                logging.debug(e)
+                logging.info('SQLite R*Tree support is unavailable; using the grid engine')
+                return False
+
+            bases_sql = bases_sql.format(bases=self.get_bases_sql(),
+                                         owners=self.load_temp_ids('smss_account_ids', account_ids))
+            self.get_result_set(bases_sql, params)
+            self.get_result_set(update_sql.format(objects_sql), params)
+            self.reset_counts[thing] += self.rows_changed
+            self.get_result_set('DROP TABLE temp.smss_base_rtree')
+        return True
 
 
     def reset_tent_timers(self):
@@ -677,18 +2514,24 @@ class SmssConfig:
         if self.config.get('reset_all_tents', False):
             sql = "UPDATE Structures SET AbandonTimer=2419200 WHERE ClassName like '%tent%';"
             self.get_result_set(sql)
+            self.reset_counts['tent'] += self.rows_changed
             return
 
-        if not self.reset_tent_owner_ids:
+        if not self.reset_tent_account_ids:
             return
+
+        sql = "UPDATE Structures SET AbandonTimer=2419200 WHERE StructureID IN ({});"
+
+        if self.distance_engine == 'rtree':
+            if self.reset_base_object_timers_rtree(self.get_tents_sql(), self.reset_tent_account_ids, sql, 'tent'):
+                return
         
         tents = self.get_result_set(self.get_tents_sql())
 
         if not tents:
             return
 
-        sql = "UPDATE Structures SET AbandonTimer=2419200 WHERE StructureID IN ({});"
-        self.reset_base_object_timers(tents, self.reset_tent_owner_ids, sql, 'tent')
+        self.reset_base_object_timers(tents, self.reset_tent_account_ids, sql, 'tent')
 
 
     def quick_vehicle_despawn(self):
@@ -707,18 +2550,59 @@ class SmssConfig:
         if self.config.get('reset_all_vechicles', False):
             sql = "UPDATE Vehicles SET AbandonTimer=2419200;"
             self.get_result_set(sql)
+            self.reset_counts['vehicle'] += self.rows_changed
             return
 
-        if not self.reset_vehicle_owner_ids:
+        if not self.reset_vehicle_account_ids:
             return
+
+        sql = "UPDATE Vehicles SET AbandonTimer=2419200 WHERE VehicleID IN ({});"
+
+        if self.distance_engine == 'rtree':
+            if self.reset_base_object_timers_rtree(self.get_vehicles_sql(), self.reset_vehicle_account_ids, sql, 'vehicle'):
+                return
         
         vehicles = self.get_result_set(self.get_vehicles_sql())
 
         if not vehicles:
             return
 
-        sql = "UPDATE Vehicles SET AbandonTimer=2419200 WHERE VehicleID IN ({});"
-        self.reset_base_object_timers(vehicles, self.reset_vehicle_owner_ids, sql, 'vehicle')
+        self.reset_base_object_timers(vehicles, self.reset_vehicle_account_ids, sql, 'vehicle')
+
+
+    def run_online_steps(self, steps):
+        """Runs online database maintenance steps, resuming with the step
+           the previous run stopped at, within online_maintenance_budget_ms
+
+        Args:
+            steps (tuple): functions making up the maintenance
+
+        Returns:
+            bool: False if the run stopped because the database was busy
+        """
+        import sqlite3
+
+        deadline = time.perf_counter() + self.online_maintenance_budget
+        while self.online_maintenance_step < len(steps):
+            if time.perf_counter() >= deadline:
+                logging.debug('Online database maintenance out of time; resuming next run')
+                return True
+            try:
+                # Take the write lock up front so busy_timeout covers waiting for it
+                with self.database_session(self.online_database_pragmas, begin='BEGIN IMMEDIATE') as conn:
+                    conn.set_progress_handler(lambda: time.perf_counter() >= deadline, 1000)
+                    steps[self.online_maintenance_step]()
+            except sqlite3.OperationalError as e:
+                if 'interrupted' not in str(e):
+                    logging.debug(f'Online database maintenance stopped: {e}')
+                    return False
+                logging.info('Online database maintenance step {} exceeded online_maintenance_budget_ms '
+                             'and was skipped'.format(self.online_maintenance_step + 1))
+                self.online_maintenance_step = (self.online_maintenance_step + 1) % len(steps)
+                return True
+            self.online_maintenance_step += 1
+        self.online_maintenance_step = 0
+        return True
 
 
     def setup_admin(self):
@@ -739,7 +2623,17 @@ class SmssConfig:
         
         # Assign sever_owner as the ServerOwner value in the mod config file
         admin_config = Path(f"{admin_config_path}/settings.cfg")
-        self.replace_config_lines(admin_config, 'ServerOwner', server_owner)
+        self.replace_config_lines(admin_config, {'ServerOwner': server_owner})
+
+
+    def single_run_file_exists(self):
+        """If any file staring with "single_run" exists in the script
+            directory then return True
+        """
+        if len(glob(str(Path(f'{self.script_path}/single_run*')))):
+            logging.info('single_run file exists')
+            return True
+        return False
 
 
     def spinner(self):
@@ -755,6 +2649,23 @@ class SmssConfig:
         sys.stdout.write('\r')
 
                 
+    def start_prestage(self):
+        """Starts the background pre-stage worker if it is enabled and the
+           expected server uptime is known
+        """
+        if not self.prestage_enabled or self.http.offline:
+            return
+        expected_uptime = self.get_expected_uptime()
+        if expected_uptime is None:
+            logging.debug('Expected uptime unknown; not pre-staging')
+            return
+        delay = max(0, expected_uptime - self.prestage_lead_minutes * 60)
+        logging.debug(f'Pre-staging the next session in {delay:.0f} seconds')
+        self.prestage_cancel.clear()
+        self.prestage_thread = threading.Thread(target=self.prestage_worker, args=(delay,), daemon=True)
+        self.prestage_thread.start()
+
+
     def stop_file_exists(self):
         """If any file staring with "stop" exists in the script directory then
             return True
@@ -765,30 +2676,105 @@ class SmssConfig:
         return False
 
 
+    def sync_server_mods(self):
+        """Removes the mods in the Mods directory which are stale so the
+           latest versions are installed in the Miscreated directory. We do
+           this because Steam doesn't properly validate and refresh the mods;
+           this does not force the mods to redownload each time as they are
+           cached by steamcmd. A mod is stale if it is no longer configured,
+           or if its Workshop time_updated differs from (or, being unknown,
+           can't be compared with) the one recorded when it was last kept.
+        """
+        logging.debug('method: sync_server_mods')
+        if self.http.offline:
+            # Removed mods couldn't be downloaded again
+            return
+        mods_dir = Path('{}/Mods'.format(self.miscreated_server_path))
+        details = self.get_mod_details()
+
+        try:
+            with open(self.mods_manifest_file) as f:
+                manifest = json.load(f)
+        except Exception as e:
+            logging.debug(e)
+            manifest = dict()
+
+        if os.path.exists(mods_dir):
+            for mod_path in mods_dir.iterdir():
+                start_time = time.perf_counter()
+                mod_id = mod_path.name
+                time_updated = details.get(mod_id, {}).get('time_updated')
+                if mod_id not in self.mod_ids:
+                    reason = 'no longer configured'
+                elif time_updated is None:
+                    reason = 'update time unknown'
+                elif manifest.get(mod_id) != time_updated:
+                    reason = 'updated on the Workshop'
+                else:
+                    logging.debug(f'Mod {mod_id} is current')
+                    continue
+                try:
+                    if mod_path.is_dir():
+                        shutil.rmtree(mod_path)
+                    else:
+                        os.remove(mod_path)
+                except OSError as e:
+                    logging.debug("Error: {} : {}".format(mod_path, e.strerror))
+                logging.info(f'Refreshing mod {mod_id} ({reason}); removed in '
+                             f'{time.perf_counter() - start_time:.2f}s')
+
+        manifest = {mod_id: mod['time_updated'] for mod_id, mod in details.items()}
+        temp_file = Path(f'{self.mods_manifest_file}.tmp')
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_file, self.mods_manifest_file)
+
+
     def validate_miscreated_server(self):
         """Validates the Miscreated server. This also has the effect of
            installing the server if not yet installed.
         """
         logging.debug('method: validate_miscreated_server')
 
-        installed_server_build_id = int(self.config.get("server_build_id", 0))
+        installed_server_build_id = self.get_installed_build_id()
         current_server_build_id = int(self.get_server_build_id())
-        self.config['server_build_id'] = current_server_build_id
-        self.write_json_cfg()
+        if current_server_build_id != -1:
+            self.config['server_build_id'] = current_server_build_id
+            self.write_json_cfg()
         
         build_ids_match = (installed_server_build_id == current_server_build_id)
         miscreated_binary_exists = os.path.exists(self.miscreated_server_cmd)
         server_build_non_negative = (current_server_build_id != -1)
 
+        # If the installed Miscreated server has the same build id as the steam build ID,
+        # and if server_build_non_negative is true, it's up to date.
+        install_current = miscreated_binary_exists and build_ids_match and server_build_non_negative
+
         if not server_build_non_negative:
             logging.info('The current server build could not be retrieved from api.steamcmd.net.')
-            logging.info('The server will be validated in case there\'s a difference in versions.')
-        
-        # If the installed Miscreated server has the same build id as the steam build ID,
-        # and if server_build_non_negative is true, return.
-        if miscreated_binary_exists and build_ids_match and server_build_non_negative:
+            # An install SteamCMD has recorded a build for is kept as it is
+            # rather than revalidated on every failed lookup
+            if miscreated_binary_exists and installed_server_build_id is not None:
+                logging.info(f'Using the installed server build {installed_server_build_id}.')
+                install_current = True
+            else:
+                logging.info('The server will be validated in case there\'s a difference in versions.')
+
+        if self.http.offline and miscreated_binary_exists:
+            logging.info('Offline mode; the Miscreated Server installation will not be validated.')
             return
 
+        # An up to date install is only validated if its files have drifted
+        # from the integrity manifest
+        if install_current:
+            install_drift = self.install_drift_detected()
+            if install_drift is None:
+                logging.info('Recording the Miscreated Server integrity manifest...')
+                self.record_install_manifest()
+            if not install_drift:
+                return
+            logging.info('Miscreated Server files have changed and will be validated.')
+
         # Create the command used to validate/install the server
         install_cmd = 'steam_cmd +login anonymous +force_install_dir miscreated_server_path '\
                       '+app_update 302200 validate +quit'
@@ -801,41 +2787,360 @@ class SmssConfig:
         self.spinner_done=False
         t = threading.Thread(target=self.spinner)
         t.start()
-        asyncio.run(self.run(install_cmd))
+        exit_code = asyncio.run(self.run(install_cmd))
         self.spinner_done=True
         logging.info('Miscreated Server installation validated')
 
+        if exit_code == 0:
+            self.record_install_manifest()
+
+
+    def verify_archive(self, zip_file, sha256=None):
+        """Checks a downloaded zip archive before it is extracted
+
+        Args:
+            zip_file (Path): zip archive
+            sha256 (string): optional expected SHA-256 hex digest
+
+        Returns:
+            bool: True if the archive is a readable zip matching the digest
+                  whose members all pass their CRC check
+        """
+        import zipfile
+
+        logging.debug('method: verify_archive')
+        if sha256:
+            digest = hashlib.sha256()
+            with open(zip_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            if digest.hexdigest().lower() != sha256.lower():
+                logging.info('SHA-256 mismatch for {}'.format(zip_file))
+                return False
+
+        try:
+            with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+                if not zip_ref.infolist():
+                    return False
+                # Reads every member, so corrupt contents are found before anything is extracted
+                bad_member = zip_ref.testzip()
+        except Exception as e:
+            logging.debug(e)
+            return False
+        if bad_member is not None:
+            logging.info('Corrupt member {} in {}'.format(bad_member, zip_file))
+            return False
+        return True
+
+
+    def wait_for_prestage(self):
+        """Cancels a pre-stage worker which hasn't started yet, or waits for
+           one which is already downloading to finish
+        """
+        if self.prestage_thread is None:
+            return
+        self.prestage_cancel.set()
+        self.prestage_thread.join()
+        self.prestage_thread = None
+
 
     def write_hosting_cfg(self):
-        """Writes the hosting.cfg file with the current class values
+        """Writes the hosting.cfg file with the current class values if they
+           differ from the file's contents
         """
         logging.debug('method: write_hosting_cfg')
         logging.debug(f'hosting_config: {self.hosting_config}')
-        hosting_cfg = open(self.miscreated_server_config, "w")
+        hosting_cfg = SmssConfigFile(self.miscreated_server_config)
+        hosting_cfg.lines = list()
         for key, value in self.hosting_config.items():
             if type(value) is str:
                 if not len(value):
                     continue
             if type(value) is list:
                 for this_val in value:
-                    hosting_cfg.write(f"{key}={this_val}\n")
+                    hosting_cfg.lines.append(f"{key}={this_val}")
                 continue
             if key in ('sv_servername', 'sv_motd', 'sv_url'):
                 value=f"\"{value}\""
-            hosting_cfg.write(f"{key}={value}\n")
-        hosting_cfg.close()
+            hosting_cfg.lines.append(f"{key}={value}")
+        hosting_cfg.save()
 
 
     def write_json_cfg(self):
-        """Writes the json config file with the current class values
+        """Writes the json config file with the current class values if they
+           differ from the file's contents
         """
         logging.debug('method: write_json_cfg')
         this_config = deepcopy(self.config)
         this_config.pop('config_file')
-        contents = json.dumps(this_config, indent=4)
-        smss_json = open(f"{self.config_file}", "w")
-        smss_json.write(contents)
-        smss_json.close()
+        smss_json = SmssConfigFile(self.config_file, 'json')
+        smss_json.data = this_config
+        smss_json.save()
+
+
+    def write_trace(self):
+        """Writes the spans traced during this run to smss_trace.json in the
+           Chrome trace event format
+        """
+        tracer.write_chrome_trace(Path(f"{self.script_path}/smss_trace.json"))
+
+
+def open_journal(journal_file):
+    """
+    Summary: Opens the run journal, creating its sessions table if needed.
+
+    Returns:
+        sqlite3.Connection: connection to the run journal
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(journal_file)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id INTEGER PRIMARY KEY,
+            started_at REAL NOT NULL,
+            ended_at REAL NOT NULL,
+            build_id INTEGER,
+            mods TEXT,
+            downtime REAL,
+            prepare_time REAL,
+            phases TEXT,
+            db_size INTEGER,
+            bases_reset INTEGER,
+            tents_reset INTEGER,
+            vehicles_reset INTEGER,
+            uptime REAL,
+            exit_code INTEGER)
+        """)
+    return conn
+
+
+def percentile(values, percent):
+    """
+    Summary: Nearest-rank percentile of a list of values.
+
+    Returns:
+        float: the percentile, or None if there are no values
+    """
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def report_journal(journal_file, days):
+    """
+    Summary: Prints percentiles of the sessions journaled within the last
+    days, followed by a weekly trend of the same sessions.
+
+    Args:
+        journal_file (Path): run journal database
+        days (int): how many days of sessions to report
+    """
+    if not journal_file.exists():
+        print('No sessions have been journaled yet.')
+        return
+
+    since = time.time() - days * 86400
+    with closing(open_journal(journal_file)) as conn:
+        columns = ('started_at', 'build_id', 'downtime', 'prepare_time', 'phases', 'db_size',
+                   'bases_reset', 'tents_reset', 'vehicles_reset', 'uptime', 'exit_code')
+        rows = conn.execute(f"SELECT {', '.join(columns)} FROM sessions "
+                            "WHERE started_at >= ? ORDER BY started_at", (since,)).fetchall()
+    sessions = [dict(zip(columns, row)) for row in rows]
+    if not sessions:
+        print(f'No sessions were journaled in the last {days} days.')
+        return
+
+    premature = sum(1 for s in sessions if s['uptime'] < 10)
+    builds = sorted({s['build_id'] for s in sessions if s['build_id']})
+    print(f'{len(sessions)} sessions in the last {days} days, {premature} exited in less than 10 seconds')
+    print(f'Server builds: {", ".join(str(build) for build in builds) or "<unknown>"}')
+    print()
+
+    metrics = [
+        ('downtime (s)', [s['downtime'] for s in sessions]),
+        ('prepare time (s)', [s['prepare_time'] for s in sessions]),
+        ('uptime (h)', [s['uptime'] / 3600 for s in sessions]),
+        ('database (MB)', [s['db_size'] / 1048576 if s['db_size'] else None for s in sessions]),
+        ('bases reset', [s['bases_reset'] for s in sessions]),
+        ('tents reset', [s['tents_reset'] for s in sessions]),
+        ('vehicles reset', [s['vehicles_reset'] for s in sessions])]
+    phases = dict()
+    for index, s in enumerate(sessions):
+        for name, duration in json.loads(s['phases'] or '{}').items():
+            phases.setdefault(name, [None] * len(sessions))[index] = duration
+    metrics.extend((f'  {name} (s)', values) for name, values in phases.items())
+
+    print(f'{"":<32}{"p50":>10}{"p90":>10}{"p99":>10}{"max":>10}')
+    for label, values in metrics:
+        stats = [percentile(values, percent) for percent in (50, 90, 99, 100)]
+        print(f'{label:<32}' + ''.join('{:>10}'.format('-' if stat is None else f'{stat:.2f}') for stat in stats))
+    print()
+
+    weeks = dict()
+    for s in sessions:
+        year, week, _ = date.fromtimestamp(s['started_at']).isocalendar()
+        weeks.setdefault(f'{year}-W{week:02}', list()).append(s)
+
+    print(f'{"week":<10}{"sessions":>10}{"premature":>11}{"downtime p50":>14}'
+          f'{"prepare p50":>13}{"uptime p50":>12}{"database MB":>13}')
+    for week, week_sessions in weeks.items():
+        downtime = percentile([s['downtime'] for s in week_sessions], 50)
+        prepare = percentile([s['prepare_time'] for s in week_sessions], 50)
+        uptime = percentile([s['uptime'] / 3600 for s in week_sessions], 50)
+        db_size = max((s['db_size'] or 0 for s in week_sessions), default=0) / 1048576
+        print(f'{week:<10}{len(week_sessions):>10}'
+              f'{sum(1 for s in week_sessions if s["uptime"] < 10):>11}'
+              f'{"-" if downtime is None else f"{downtime:.1f}s":>14}'
+              f'{prepare:>12.1f}s{uptime:>11.2f}h{db_size:>13.1f}')
+
+
+def report_startup_time(budget_ms):
+    """
+    Summary: Measures how long importing this script takes with Python's
+    -X importtime instrumentation, prints the slowest imports, and compares
+    the total with a budget.
+
+    Args:
+        budget_ms (float): startup budget in milliseconds
+
+    Returns:
+        bool: True if the import time is within the budget
+    """
+    import subprocess
+
+    script_path = os.path.dirname(os.path.realpath(__file__))
+    module = Path(__file__).stem
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=script_path, capture_output=True, text=True)
+
+    # Lines are printed as each import finishes, so the script's own imports
+    # are the ones listed after the previous top level import
+    imports = list()
+    total_us = None
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)', line)
+        if not match:
+            continue
+        cumulative_us, depth, name = int(match.group(2)), len(match.group(3)) // 2, match.group(4)
+        if depth == 0 and name != module:
+            imports = list()
+        elif depth == 1:
+            imports.append((cumulative_us, name))
+        if depth == 0 and name == module:
+            total_us = cumulative_us
+
+    if total_us is None:
+        print(f'Could not measure the import time of {module}:')
+        print(result.stderr)
+        return False
+
+    print(f'Slowest imports of {module}:')
+    for cumulative_us, name in sorted(imports, reverse=True)[:10]:
+        print(f'{cumulative_us / 1000:>10.1f} ms  {name}')
+    total_ms = total_us / 1000
+    within_budget = total_ms <= budget_ms
+    print(f'{total_ms:>10.1f} ms  total ({"within" if within_budget else "OVER"} the {budget_ms:g} ms budget)')
+    return within_budget
+
+
+def run_session(smss):
+    """
+    Summary: Prepares and runs a single Miscreated server session.
+
+    Returns:
+        float: how long the server process ran, in seconds
+    """
+    tracer.reset()
+    prepare_time = time.time()
+
+    def database_tricks():
+        try:
+            smss.database_tricks()
+        except Exception as e:
+            logging.info(e)
+
+    # Steps which don't depend on each other run concurrently
+    scheduler = SmssScheduler(workers=int(smss.config.get('startup_workers', 4)))
+
+    # Setup admin using Theros admin mod.
+    scheduler.add('setup_admin', smss.setup_admin)
+
+    # Execute database maintenance "tricks"
+    scheduler.add('database_tricks', database_tricks)
+
+    # Prepare the Miscreated server
+    scheduler.add('sync_server_mods', smss.sync_server_mods)
+    scheduler.add('get_steam', smss.get_steam)
+    scheduler.add('apply_staged_update', smss.apply_staged_update)
+
+    # Write hosting.cfg once a staged update can no longer replace it
+    scheduler.add('write_hosting_cfg', smss.write_hosting_cfg, after=('apply_staged_update',))
+
+    # Validation walks the server directory, so nothing else writes there
+    scheduler.add('validate_miscreated_server', smss.validate_miscreated_server,
+                  after=('get_steam', 'apply_staged_update', 'write_hosting_cfg', 'setup_admin'))
+    scheduler.add('prefetch_mods', smss.prefetch_mods,
+                  after=('sync_server_mods', 'validate_miscreated_server'))
+
+    asyncio.run(scheduler.run_steps())
+    critical_path = scheduler.critical_path()
+    smss.critical_path = [name for name, _ in critical_path]
+    logging.info('Startup critical path: ' + ' -> '.join(
+        f'{name} ({duration:.1f}s)' for name, duration in critical_path))
+
+    # Record the time we start the server
+    start_time = time.time()
+    db_size = smss.get_database_size()
+
+    # # Launch the Miscreated server
+    exit_code = smss.launch_server()
+    uptime = time.time() - start_time
+
+    smss.write_trace()
+    smss.record_session(prepare_time, start_time, db_size, uptime, exit_code)
+    return uptime
+
+
+def supervise(smss):
+    """
+    Summary: Restarts the server from this process until a stop or single_run
+    file exists, keeping the SmssConfig state warm between sessions. Servers
+    which exit within ten seconds, and sessions which fail with an exception,
+    are restarted after an exponential backoff with jitter. smss.cmd runs
+    this mode when a file starting with "supervise" exists.
+    """
+    backoff_base = float(smss.config.get('restart_backoff_base', 10))
+    backoff_max = float(smss.config.get('restart_backoff_max', 300))
+    failures = 0
+    first_session = True
+
+    while not smss.stop_file_exists():
+        if not first_session:
+            smss.new_session()
+        first_session = False
+
+        try:
+            uptime = run_session(smss)
+        except Exception as e:
+            # A failed session is retried like a server which exited early
+            # rather than ending the supervisor
+            logging.exception(f'Session failed: {e}')
+            uptime = 0
+
+        if smss.stop_file_exists() or smss.single_run_file_exists():
+            break
+
+        if uptime >= 10:
+            failures = 0
+            continue
+
+        failures += 1
+        delay = min(backoff_max, backoff_base * 2 ** (failures - 1))
+        delay = uniform(delay / 2, delay)
+        print(f"The server session failed or exited in less than 10 seconds. Restarting in {delay:.0f} seconds.")
+        time.sleep(delay)
 
 
 def main():
@@ -843,6 +3148,9 @@ def main():
     Summary: Default method if this module is run as __main__.
     """
     import argparse
+    from colorama import init
+
+    init(convert=True)
 
     # Argeparse description and configuration
     prog = os.path.basename(__file__)
@@ -850,6 +3158,16 @@ def main():
                   "configured in a JSON formatted file will use Miscreated "\
                   "server defaults.".format(prog=prog)
     parser = argparse.ArgumentParser(prog=prog, description=description)
+    parser.add_argument('--supervise', action='store_true',
+                        help='keep running and restart the server from this process')
+    parser.add_argument('--offline', action='store_true',
+                        help='make no network requests and use the last known build IDs and mod details')
+    parser.add_argument('--startup-report', action='store_true',
+                        help='report the import time of this script against startup_budget_ms and exit')
+    subparsers = parser.add_subparsers(dest='command')
+    journal_parser = subparsers.add_parser('journal', help='report percentiles and weekly trends from the run journal')
+    journal_parser.add_argument('--days', type=int, default=30,
+                                help='only report sessions started within this many days (default: 30)')
     args = parser.parse_args()
 
     # This just grabs our script's path for reuse
@@ -894,31 +3212,28 @@ def main():
     
     json_config['config_file'] = f"{json_config_file}"
 
+    if args.startup_report:
+        budget_ms = float(json_config.get('startup_budget_ms', 150))
+        sys.exit(0 if report_startup_time(budget_ms) else 1)
+
+    if args.command == 'journal':
+        report_journal(Path(f"{script_path}/smss_journal.db"), args.days)
+        return
+
     smss = SmssConfig(**json_config)
 
-    # Setup admin using Theros admin mod.
-    smss.setup_admin()
-    
-    # Write hosting.cfg
-    smss.write_hosting_cfg()
-    
-    # Prepare the Miscreated server
-    smss.prepare_server()
-    
-    # Execute database maintenance "tricks"
-    try:
-        smss.database_tricks()
-    except Exception as e:
-        logging.info(e)
+    # Not stored in the configuration, which is written back to smss.json
+    if args.offline:
+        smss.http.offline = True
 
-    # Record the time we start the server
-    start_time = time.time()
+    if args.supervise:
+        supervise(smss)
+        return
 
-    # # Launch the Miscreated server
-    smss.launch_server()
+    uptime = run_session(smss)
 
     # If the server executed prematurely sleep before exiting this script
-    if time.time() - start_time < 10:
+    if uptime < 10:
         print("The server process exited in less than 10 seconds. This script will sleep for five minutes before restarting.")
         time.sleep(300)
     